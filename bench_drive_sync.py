@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Check of the incremental image sync: random Drive changes applied from the changes feed must give the same images
+as listing all folders again, and cost less
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+import bench_fakes
+import prompts_store
+
+logging.disable(logging.INFO)
+
+
+class DriveMutator:
+    """Random changes to the fake Drive: images added, removed, trashed, renamed and moved, other files added,
+    and now and then a category folder added or renamed"""
+
+    def __init__(self, drive_files, rnd):
+        self.files = drive_files
+        self.rnd = rnd
+        self.new_ids = iter(range(1, 1 << 62))
+
+    def folders(self):
+        return [
+            file_id for file_id, file in self.files.files.items() if file["mimeType"] == prompts_store.FOLDER_MIME_TYPE
+        ]
+
+    def images(self):
+        return [file_id for file_id, file in self.files.files.items() if file["mimeType"].startswith("image/")]
+
+    def add_image(self):
+        file_id = f"new{next(self.new_ids)}"
+        self.files.change(
+            file_id,
+            name=f"{file_id}.png",
+            mimeType="image/png",
+            parents=[self.rnd.choice(self.folders())],
+            webContentLink=f"https://drive.example/{file_id}.png",
+        )
+
+    def remove_image(self):
+        self.files.remove(self.rnd.choice(self.images()))
+
+    def trash_image(self):
+        file_id = self.rnd.choice(self.images())
+        self.files.change(file_id, trashed=not self.files.files[file_id].get("trashed"))
+
+    def rename_image(self):
+        self.files.change(self.rnd.choice(self.images()), name=f"renamed{next(self.new_ids)}.jpg")
+
+    def move_image(self):
+        # Into another category, or out of all of them
+        parent = self.rnd.choice(self.folders() + ["elsewhere"])
+        self.files.change(self.rnd.choice(self.images()), parents=[parent])
+
+    def add_other_file(self):
+        file_id = f"doc{next(self.new_ids)}"
+        self.files.change(file_id, name=file_id, mimeType="text/plain", parents=[self.rnd.choice(self.folders())])
+
+    def add_folder(self):
+        file_id = f"folder-new{next(self.new_ids)}"
+        parents = [bench_fakes.BASE_FOLDER_ID]
+        self.files.change(file_id, name=file_id, mimeType=prompts_store.FOLDER_MIME_TYPE, parents=parents)
+
+    def rename_folder(self):
+        self.files.change(self.rnd.choice(self.folders()), name=f"Renamed{next(self.new_ids)}")
+
+    def mutate(self, count, folder_changes):
+        image_changes = [
+            self.add_image,
+            self.remove_image,
+            self.trash_image,
+            self.rename_image,
+            self.move_image,
+            self.add_other_file,
+        ]
+        for _ in range(count):
+            if self.rnd.random() < folder_changes:
+                self.rnd.choice([self.add_folder, self.rename_folder])()
+            else:
+                self.rnd.choice(image_changes)()
+
+
+def by_category(catalog):
+    """The images of every category regardless of their order, which Drive does not promise"""
+    return {category: sorted(catalog.folder(category)) for category in catalog.categories}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--trials", type=int, default=300)
+    parser.add_argument("--changes", type=int, default=10, help="most Drive changes between two refreshes")
+    parser.add_argument("--images-per-folder", type=int, default=2000)
+    parser.add_argument("--folder-changes", type=float, default=0.01, help="share of changes to the folders")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    store = bench_fakes.make_prompts_store(images_per_folder=args.images_per_folder)
+    mutator = DriveMutator(store.drive_service, rnd)
+    incremental_time = full_time = 0
+    mismatches = 0
+    for trial in range(args.trials):
+        mutator.mutate(rnd.randint(1, args.changes), args.folder_changes)
+        start = time.perf_counter()
+        store.load(only_if_stale=True)
+        incremental_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        relisted = prompts_store.PromptsStore(
+            sheets_service=store.sheets_service,
+            drive_service=store.drive_service,
+            changes_service=store.changes_service,
+            snapshot_file=None,
+        )
+        full_time += time.perf_counter() - start
+        if (
+            by_category(store.images) != by_category(relisted.images)
+            or store.sync.folder_ids != relisted.sync.folder_ids
+        ):
+            mismatches += 1
+            print(f"trial {trial}: the incremental sync differs from a full relist")
+
+    print(f"{args.trials} refreshes of {store.images.count(prompts_store.ImageCatalog.ALL)} images")
+    print(f"  incremental: {incremental_time / args.trials * 1000:.2f} ms per refresh")
+    print(f"  full relist: {full_time / args.trials * 1000:.2f} ms per refresh, including the sheets")
+    if mismatches:
+        sys.exit(f"FAILED: {mismatches} of {args.trials} refreshes differ from a full relist")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
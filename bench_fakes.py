@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fake Telegram Bot API and Google services for the benchmarks, answering from memory without any network
+"""
+
+import asyncio
+import itertools
+import json
+import random
+from collections import Counter
+
+from telegram.request import BaseRequest
+
+import prompts_store
+
+BOT_ID = 1000
+BOT_USERNAME = "bench_bot"
+ADMIN_ID = 1
+HEADERS = ["Персонаж", "Місце", "Подія", "Предмет"]
+# The image categories of the /image_<category> commands
+FOLDERS = ["Character", "Location", "Other"]
+# The store takes its base folder from the environment, the fake Drive needs one to tell the category folders apart
+BASE_FOLDER_ID = prompts_store.PromptsStore.base_folder_id or "base-folder"
+prompts_store.PromptsStore.base_folder_id = BASE_FOLDER_ID
+
+
+class FakeBotAPI(BaseRequest):
+    """Answers every Bot API call like Telegram would, after `latency` seconds, and counts the calls"""
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def make_message(self, parameters):
+        chat_id = int(parameters.get("chat_id", 0))
+        return {
+            "message_id": parameters.get("message_id") or next(self.message_ids),
+            "date": 0,
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private", "title": "Bench"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME},
+            "text": parameters.get("text", ""),
+        }
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        self.calls[name] += 1
+        parameters = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if name == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME}
+        elif name in ("sendMessage", "editMessageText"):
+            result = self.make_message(parameters)
+        elif name == "sendPhoto":
+            result = self.make_message(parameters)
+            photo = parameters.get("photo")
+            # An uploaded photo gets a new file id, a file id is sent as is
+            uploaded = not isinstance(photo, str) or photo.startswith("attach://")
+            file_id = f"photo{next(self.message_ids)}" if uploaded else photo
+            result["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}]
+        elif name == "getChatAdministrators":
+            result = [{"status": "creator", "is_anonymous": False, "user": make_user(ADMIN_ID)}]
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeGoogleRequest:
+    def __init__(self, result, method_id):
+        self.result = result
+        self.methodId = method_id
+
+    def execute(self, http=None):
+        return self.result
+
+
+class FakeSheets:
+    """The config and prompts sheets, read by columns"""
+
+    def __init__(self, languages, prompts_per_header, rnd):
+        rows = [
+            ["help_message", "", "", "Бот для письменників"],
+            ["languages", "", "", ",".join(languages)],
+        ]
+        width = max(map(len, rows))
+        self.config = [[row[i] if i < len(row) else "" for row in rows] for i in range(width)]
+        self.prompts = {
+            lang: [
+                [header] + [f"{header} {lang} {rnd.random():.6f}" for _ in range(prompts_per_header)]
+                for header in HEADERS
+            ]
+            for lang in languages
+        }
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension):
+        value_ranges = []
+        for sheet_range in ranges:
+            lang = sheet_range.split("!")[0].removeprefix("База-")
+            value_ranges.append({"values": self.prompts[lang] if sheet_range.startswith("База-") else self.config})
+        return FakeGoogleRequest({"valueRanges": value_ranges}, "sheets.spreadsheets.values.batchGet")
+
+
+class FakeDriveFiles:
+    """The base folder of the store, as it appears in its queries, with image folders in it.
+    Every change made through change() and remove() is recorded for FakeDriveChanges"""
+
+    def __init__(self, images_per_folder):
+        self.files = {}
+        self.changes = []
+        for i, name in enumerate(FOLDERS):
+            self.files[f"folder{i}"] = {
+                "name": name,
+                "mimeType": prompts_store.FOLDER_MIME_TYPE,
+                "parents": [BASE_FOLDER_ID],
+            }
+            for j in range(images_per_folder):
+                self.files[f"image{i}-{j}"] = {
+                    "name": f"{j}.jpg",
+                    "mimeType": "image/jpeg",
+                    "parents": [f"folder{i}"],
+                    "webContentLink": f"https://drive.example/{i}/{j}.jpg",
+                }
+
+    def change(self, file_id, **fields):
+        """Create a file or change its fields, e.g. name, parents or trashed"""
+        file = self.files.setdefault(file_id, {"name": file_id, "mimeType": "image/jpeg", "parents": []})
+        file.update(fields)
+        self.changes.append({"fileId": file_id, "removed": False, "file": dict(file)})
+
+    def remove(self, file_id):
+        del self.files[file_id]
+        self.changes.append({"fileId": file_id, "removed": True})
+
+    def get(self, fileId, fields):
+        return FakeGoogleRequest({"modifiedTime": "2024-01-01T00:00:00.000Z"}, "drive.files.get")
+
+    def get_media(self, fileId):
+        return FakeGoogleRequest(b"\xff\xd8\xff\xe0" + fileId.encode() * 1000, "drive.files.get_media")
+
+    def list(self, q, fields, pageSize=100, pageToken=None):
+        parent = q.split("'")[1]
+        want_folders = prompts_store.FOLDER_MIME_TYPE in q
+        matching = [
+            {"id": file_id, "name": file["name"], "webContentLink": file.get("webContentLink")}
+            for file_id, file in self.files.items()
+            if parent in file["parents"]
+            and (file["mimeType"] == prompts_store.FOLDER_MIME_TYPE) == want_folders
+            and (want_folders or file["mimeType"].startswith("image/"))
+            and not (file.get("trashed") and "trashed = false" in q)
+        ]
+        start = int(pageToken or 0)
+        response = {"files": matching[start : start + pageSize]}
+        if start + pageSize < len(matching):
+            response["nextPageToken"] = str(start + pageSize)
+        return FakeGoogleRequest(response, "drive.files.list")
+
+
+class FakeDriveChanges:
+    """The changes feed of FakeDriveFiles, a page token is the number of changes made before it"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def getStartPageToken(self):
+        return FakeGoogleRequest({"startPageToken": str(len(self.files.changes))}, "drive.changes.getStartPageToken")
+
+    def list(self, pageToken, pageSize=100, **kwargs):
+        start = int(pageToken)
+        response = {"changes": self.files.changes[start : start + pageSize]}
+        if start + pageSize < len(self.files.changes):
+            response["nextPageToken"] = str(start + pageSize)
+        else:
+            response["newStartPageToken"] = str(len(self.files.changes))
+        return FakeGoogleRequest(response, "drive.changes.list")
+
+
+def make_prompts_store(languages=("ua", "en"), prompts_per_header=200, images_per_folder=500, seed=0):
+    """A PromptsStore loaded from the fake Google services, without a snapshot file"""
+    drive_files = FakeDriveFiles(images_per_folder)
+    return prompts_store.PromptsStore(
+        sheets_service=FakeSheets(languages, prompts_per_header, random.Random(seed)),
+        drive_service=drive_files,
+        changes_service=FakeDriveChanges(drive_files),
+        snapshot_file=None,
+    )
+
+
+def make_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def make_message(update_id, chat_id, user_id, text):
+    """A raw message update, with the leading /command marked as a command like Telegram does"""
+    message = {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"},
+        "from": make_user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_inline_query(update_id, user_id, query, offset=""):
+    return {
+        "update_id": update_id,
+        "inline_query": {"id": str(update_id), "from": make_user(user_id), "query": query, "offset": offset},
+    }
+
+
+def make_callback_query(update_id, chat_id, user_id, data, message_id=1):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": 0,
+                "chat": {"id": chat_id, "type": "supergroup", "title": "Bench"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": BOT_USERNAME},
+                "text": "Спринт",
+            },
+        },
+    }
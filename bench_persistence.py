@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of one persistence update with many stored chats, PicklePersistence against SQLitePersistence
+"""
+
+import argparse
+import asyncio
+import os
+import pickle
+import tempfile
+import time
+
+from telegram.ext import PicklePersistence
+
+from sqlite_persistence import SQLitePersistence
+
+
+def make_chat_data(chat_id):
+    return {"last_sprint": (chat_id, 30, 5), "language": "ua"}
+
+
+def write_seed(path, chats):
+    """A db.pickle with `chats` chats, as PicklePersistence(single_file=True) writes it"""
+    data = {
+        "chat_data": {chat_id: make_chat_data(chat_id) for chat_id in range(chats)},
+        "user_data": {},
+        "bot_data": {"sprints": {}},
+        "callback_data": None,
+        "conversations": {},
+    }
+    with open(path, "wb") as seed_file:
+        pickle.dump(data, seed_file, pickle.HIGHEST_PROTOCOL)
+
+
+async def update(persistence, dirty, round_number):
+    """One Application.update_persistence round with `dirty` changed chats"""
+    start = time.perf_counter()
+    for chat_id in range(dirty):
+        await persistence.update_chat_data(chat_id, make_chat_data(chat_id + round_number))
+    await persistence.update_bot_data({"sprints": {}, "round": round_number})
+    return time.perf_counter() - start
+
+
+async def run(chats, dirty, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        seed = os.path.join(directory, "db.pickle")
+        write_seed(seed, chats)
+        sqlite = SQLitePersistence(os.path.join(directory, "db.sqlite3"))
+        sqlite.migrate_from_pickle(seed)
+        for name, persistence in (("pickle", PicklePersistence(seed)), ("sqlite", sqlite)):
+            # The application loads everything on start
+            await persistence.get_chat_data()
+            await persistence.get_bot_data()
+            best = min([await update(persistence, dirty, i + 1) for i in range(repeat)])
+            print(f"  {name:>6}: {best * 1000:9.2f} ms per update")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--dirty", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for chats in args.chats:
+        for dirty in args.dirty:
+            print(f"{chats} chats, {dirty} changed:")
+            asyncio.run(run(chats, dirty, args.repeat))
+
+
+if __name__ == "__main__":
+    main()
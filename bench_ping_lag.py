@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression check for the sprint progress ping: the event loop must keep running while the pings wait to be deleted
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from telegram import Bot
+
+import bench_fakes
+import sprint
+
+logging.disable(logging.INFO)
+os.environ.setdefault("HOSTNAME", "bench.example")
+
+# Seconds between the wake-ups of the lag monitor
+LAG_INTERVAL = 0.01
+
+
+async def monitor_lag(lags, stop):
+    """Record when every wake-up of a short sleep came and how late, which is how long the loop was blocked"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        end = time.perf_counter()
+        lags.append((end, end - start - LAG_INTERVAL))
+
+
+class TimedBotAPI(bench_fakes.FakeBotAPI):
+    """Also records when every call of a method was made"""
+
+    def __init__(self, latency=0):
+        super().__init__(latency)
+        self.times = defaultdict(list)
+
+    async def do_request(self, url, method, *args, **kwargs):
+        self.times[url.rsplit("/", 1)[-1]].append(time.perf_counter())
+        return await super().do_request(url, method, *args, **kwargs)
+
+
+def make_idle_sprint(chat_id):
+    """A running sprint that pings the chat on its next tick"""
+    idle_sprint = sprint.Sprint(30, 0)
+    idle_sprint.chat_id = chat_id
+    idle_sprint.message_id = 1
+    idle_sprint.status = sprint.SprintStatus.Running
+    idle_sprint.start_date = sprint.now()
+    idle_sprint.end_date = idle_sprint.start_date + timedelta(minutes=idle_sprint.duration)
+    idle_sprint.users = {bench_fakes.ADMIN_ID: "Admin"}
+    idle_sprint.ticks_without_activity = sprint.MAX_SPRINT_DELAY
+    return idle_sprint
+
+
+async def run(args):
+    api = TimedBotAPI(args.api_latency)
+    scheduler = sprint.SprintScheduler()
+    sprints = [make_idle_sprint(-chat) for chat in range(1, args.sprints + 1)]
+    async with Bot("1000:bench", request=api, get_updates_request=api) as bot:
+        scheduler.bot = bot
+        for idle_sprint in sprints:
+            scheduler.add(idle_sprint)
+        scheduler.start()
+        lags, stop = [], asyncio.Event()
+        monitor = asyncio.create_task(monitor_lag(lags, stop))
+        api.calls.clear()
+        api.times.clear()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(idle_sprint.tick() for idle_sprint in sprints))
+        ticked = time.perf_counter()
+        tick_time = ticked - start
+        await asyncio.sleep(args.lifetime + 0.5)
+
+        stop.set()
+        await monitor
+        scheduler.stop()
+    # Sending the pings takes CPU time of its own, only the time the pings wait to be deleted is measured
+    pending_lag = max(lag for end, lag in lags if end > ticked)
+    return tick_time, pending_lag, api.times["sendMessage"], api.times["deleteMessage"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sprints", type=int, default=200, help="sprints pinging their chats at once")
+    parser.add_argument("--lifetime", type=float, default=1, help="seconds a ping stays in the chat")
+    parser.add_argument("--api-latency", type=float, default=0.01, help="seconds every Bot API call takes")
+    parser.add_argument(
+        "--max-lag", type=float, default=0.05, help="seconds the event loop may be blocked while the pings are pending"
+    )
+    args = parser.parse_args()
+    sprint.PING_LIFETIME = args.lifetime
+
+    tick_time, max_lag, pings, deletes = asyncio.run(run(args))
+    # The pings are sent and deleted in the same order
+    shortest_life = min((delete - ping for ping, delete in zip(pings, deletes)), default=0)
+    print(f"{args.sprints} pings sent in {tick_time * 1000:.0f} ms")
+    print(f"  max event loop lag while the pings were pending: {max_lag * 1000:.1f} ms")
+    print(f"  {len(deletes)} pings deleted, each at least {shortest_life:.2f} s after it was sent")
+
+    failures = []
+    if len(pings) != args.sprints:
+        failures.append(f"{len(pings)} pings sent instead of {args.sprints}")
+    if tick_time >= args.lifetime:
+        failures.append("ticks waited for the pings to be deleted")
+    if max_lag > args.max_lag:
+        failures.append("the event loop was blocked while the pings were pending")
+    if len(deletes) != args.sprints or shortest_life < args.lifetime:
+        failures.append("the pings were not deleted after their lifetime")
+    if failures:
+        sys.exit("FAILED: " + "; ".join(failures))
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
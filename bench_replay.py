@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark: replays update streams through the real Application against a fake Bot API and fake Google
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+
+import bench_fakes
+import bot
+from bench_wordcount import make_text
+
+logging.disable(logging.INFO)
+os.environ.setdefault("TELEGRAM_TOKEN", "1000:bench")
+os.environ.setdefault("BOT_SUPERADMINS", str(bench_fakes.ADMIN_ID))
+
+COMMANDS = ["/start", "/help", "/prompt", "/prompt_en", "/image", "/image_character", "/stats"]
+
+
+def make_commands(count, chats, rnd):
+    return [
+        bench_fakes.make_message(i, -rnd.randrange(1, chats + 1), rnd.randrange(10, 1000), rnd.choice(COMMANDS))
+        for i in range(count)
+    ]
+
+
+def make_wordcounts(count, chats, rnd, words=2000):
+    texts = [make_text(words, seed) for seed in range(8)]
+    return [
+        bench_fakes.make_message(i, -rnd.randrange(1, chats + 1), rnd.randrange(10, 1000), "/wc " + rnd.choice(texts))
+        for i in range(count)
+    ]
+
+
+def make_sprint_storms(count, chats, rnd):
+    """A /sprint in every chat, followed by join and leave button presses of many users in all of them"""
+    updates = [
+        bench_fakes.make_message(chat, -chat, bench_fakes.ADMIN_ID, "/sprint 30 5") for chat in range(1, chats + 1)
+    ]
+    for i in range(len(updates), count):
+        data = "join_sprint" if rnd.random() < 0.8 else "leave_or_cancel_sprint"
+        chat_id, user_id = -rnd.randrange(1, chats + 1), rnd.randrange(10, 1000)
+        updates.append(bench_fakes.make_callback_query(i, chat_id, user_id, data))
+    return updates
+
+
+def make_inline_queries(count, chats, rnd):
+    """Inline queries for text prompts and images, some of them asking for the next pages"""
+    queries = ["", "ua", "en", "char", "loc", "all"]
+    return [
+        bench_fakes.make_inline_query(i, rnd.randrange(10, 1000), rnd.choice(queries), rnd.choice(["", "", "1", "2"]))
+        for i in range(count)
+    ]
+
+
+STREAMS = {
+    "commands": make_commands,
+    "wc": make_wordcounts,
+    "sprints": make_sprint_storms,
+    "inline": make_inline_queries,
+}
+
+
+def record_latency(latencies, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            latencies[callback.__name__].append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def replay(updates, api_latency, rate_limit):
+    api = bench_fakes.FakeBotAPI(api_latency)
+    latencies = defaultdict(list)
+    with tempfile.TemporaryDirectory() as directory:
+        # Nothing is carried over from an earlier run
+        bot.PERSISTENCE_FILE = os.path.join(directory, "bench.sqlite3")
+        app = bot.build_app(bench_fakes.make_prompts_store(), request=api, rate_limit=rate_limit)
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                handler.callback = record_latency(latencies, handler.callback)
+
+        async with app:
+            await app.post_init(app)
+            await app.start()
+            api.calls.clear()
+            start = time.perf_counter()
+            for data in updates:
+                await app.update_queue.put(Update.de_json(data, app.bot))
+            await app.update_queue.join()
+            elapsed = time.perf_counter() - start
+            calls = dict(api.calls)
+            await app.stop()
+    return elapsed, latencies, calls
+
+
+def report(name, updates, elapsed, latencies, calls):
+    print(f"{name}: {len(updates)} updates in {elapsed:.2f} s, {len(updates) / elapsed:.0f} updates/s")
+    print(f"  {'handler':<24} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for handler, values in sorted(latencies.items()):
+        p50, p99 = percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000
+        print(f"  {handler:<24} {len(values):>7} {p50:>9.2f} {p99:>9.2f}")
+    print("  Bot API calls: " + ", ".join(f"{method} {count}" for method, count in sorted(calls.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--streams", nargs="+", choices=sorted(STREAMS), default=sorted(STREAMS))
+    parser.add_argument("--replay", help="file with one raw update as JSON per line, e.g. recorded from the webhook")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0, help="seconds every Bot API call takes")
+    parser.add_argument("--rate-limit", action="store_true", help="keep the Bot API rate limiter on")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as replay_file:
+            streams = {args.replay: [json.loads(line) for line in replay_file if line.strip()]}
+    else:
+        rnd = random.Random(args.seed)
+        streams = {name: STREAMS[name](args.updates, args.chats, rnd) for name in args.streams}
+    for name, updates in streams.items():
+        report(name, updates, *asyncio.run(replay(updates, args.api_latency, args.rate_limit)))
+
+
+if __name__ == "__main__":
+    main()
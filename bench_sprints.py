@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of thousands of concurrent sprints on a simulated clock, through the real handlers and a fake Bot API
+"""
+
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import pickle
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import Counter
+
+from telegram import Update
+
+import bench_fakes
+import bot
+import sprint
+
+logging.disable(logging.INFO)
+os.environ.setdefault("TELEGRAM_TOKEN", "1000:bench")
+os.environ.setdefault("BOT_SUPERADMINS", str(bench_fakes.ADMIN_ID))
+os.environ.setdefault("HOSTNAME", "bench.example")
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def count_ticks(stats, tick):
+    @functools.wraps(tick)
+    async def wrapper(self):
+        stats["ticks"] += 1
+        return await tick(self)
+
+    return wrapper
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.update_ids = iter(range(1, 1 << 62))
+        self.stats = Counter()
+
+    async def feed(self, updates):
+        """Process the updates like the webhook would and wait until all are handled"""
+        for data in updates:
+            await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+        await self.app.update_queue.join()
+
+    def make_traffic(self, actions):
+        """Random join, leave and cancel presses in the chats of the sprints"""
+        updates = []
+        for _ in range(actions):
+            chat_id = -self.rnd.randrange(1, self.args.sprints + 1)
+            roll = self.rnd.random()
+            if roll < self.args.cancel_share:
+                # An admin outside the sprint cancels it
+                user_id, data = bench_fakes.ADMIN_ID, "leave_or_cancel_sprint"
+            else:
+                user_id = self.rnd.randrange(10, 10 + self.args.users)
+                data = "join_sprint" if roll < 0.8 else "leave_or_cancel_sprint"
+            updates.append(bench_fakes.make_callback_query(next(self.update_ids), chat_id, user_id, data))
+        return updates
+
+    async def step(self, scheduler):
+        """One simulated second: the traffic of this second, then the due sprint events"""
+        actions = self.args.actions_per_minute // 60 + (self.rnd.random() < self.args.actions_per_minute % 60 / 60)
+        cpu = time.process_time()
+        await self.feed(self.make_traffic(actions))
+        self.stats["traffic_cpu"] += time.process_time() - cpu
+        self.stats["actions"] += actions
+        cpu = time.process_time()
+        await asyncio.gather(*scheduler.run_due(self.clock()))
+        self.stats["scheduler_cpu"] += time.process_time() - cpu
+
+    async def run(self):
+        args = self.args
+        self.clock = SimulatedClock()
+        sprint.clock = self.clock
+        sprint.Sprint.tick = count_ticks(self.stats, sprint.Sprint.tick)
+        api = bench_fakes.FakeBotAPI()
+        with tempfile.TemporaryDirectory() as directory:
+            bot.PERSISTENCE_FILE = os.path.join(directory, "bench.sqlite3")
+            self.app = bot.build_app(bench_fakes.make_prompts_store(), request=api, rate_limit=False)
+            async with self.app:
+                await self.app.post_init(self.app)
+                scheduler = self.app.post_init.__self__.sprints
+                scheduler.stop()
+                await self.app.start()
+
+                tracemalloc.start()
+                memory = tracemalloc.get_traced_memory()[0]
+                commands = [
+                    bench_fakes.make_message(
+                        next(self.update_ids),
+                        -chat,
+                        self.rnd.randrange(10, 10 + args.users),
+                        f"/sprint {args.duration} {self.rnd.randint(1, args.max_delay)}",
+                    )
+                    for chat in range(1, args.sprints + 1)
+                ]
+                await self.feed(commands)
+                per_sprint = (tracemalloc.get_traced_memory()[0] - memory) / args.sprints
+                tracemalloc.stop()
+                pickled = len(pickle.dumps(scheduler.sprints)) / args.sprints
+
+                calls_per_minute = []
+                api.calls.clear()
+                render_time = None
+                for second in range((args.max_delay + args.duration + 2) * 60):
+                    self.clock.now += 1
+                    await self.step(scheduler)
+                    if second % 60 == 59:
+                        calls_per_minute.append(api.calls.copy())
+                        api.calls.clear()
+                    if second == (args.max_delay + args.duration // 2) * 60 and scheduler.sprints:
+                        render_time = self.time_render(scheduler.sprints)
+                await self.app.stop()
+
+        self.report(per_sprint, pickled, calls_per_minute, render_time)
+
+    @staticmethod
+    def time_render(sprints):
+        """Time render_message of the running sprint with the most users"""
+        sample = max(sprints.values(), key=lambda sprint: len(sprint.users))
+        best = min(timeit.repeat(sample.render_message, number=100, repeat=5)) / 100
+        return len(sample.users), best
+
+    def report(self, per_sprint, pickled, calls_per_minute, render_time):
+        stats = self.stats
+        print(f"{self.args.sprints} sprints, {stats['actions']} button presses")
+        print(f"  memory per sprint: {per_sprint / 1024:.1f} KiB while starting, {pickled:.0f} B pickled")
+        if stats["ticks"]:
+            # Everything the scheduler runs, mostly ticks, plus the debounced edits, pings, starts and ends
+            cpu_per_tick = stats["scheduler_cpu"] / stats["ticks"] * 1e6
+            print(f"  progress ticks: {stats['ticks']}, scheduler CPU per tick: {cpu_per_tick:.0f} us")
+        if stats["actions"]:
+            print(f"  CPU per button press: {stats['traffic_cpu'] / stats['actions'] * 1e6:.0f} us")
+        totals = [sum(calls.values()) for calls in calls_per_minute]
+        print(f"  Bot API calls per minute: average {sum(totals) / len(totals):.0f}, max {max(totals)}")
+        busiest = calls_per_minute[totals.index(max(totals))]
+        print("  busiest minute: " + ", ".join(f"{method} {count}" for method, count in busiest.most_common()))
+        if render_time is not None:
+            users, best = render_time
+            print(f"  render_message of a running sprint with {users} users: {best * 1e6:.0f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sprints", type=int, default=2000)
+    parser.add_argument("--duration", type=int, default=30, help="minutes")
+    parser.add_argument("--max-delay", type=int, default=5, help="minutes")
+    parser.add_argument("--users", type=int, default=200, help="users pressing the buttons")
+    parser.add_argument("--actions-per-minute", type=int, default=1000, help="button presses over all sprints")
+    parser.add_argument("--cancel-share", type=float, default=0.002, help="share of presses that cancel a sprint")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    main()
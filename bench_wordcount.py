@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the /wc counting engine against the original implementation
+"""
+
+import argparse
+import random
+import re
+import string
+import timeit
+import tracemalloc
+
+import utils
+
+SAMPLE_WORDS = [
+    "Привіт,",
+    "світ!",
+    "—",
+    "2023",
+    "writer",
+    "«так»",
+    "...",
+    "й",
+    "п'ять",
+    "їжачок-",
+    ";",
+    "Ґанок.",
+]
+
+
+def legacy_count_text(txt):
+    """The counting code /wc used before utils.count_text"""
+    words = sum(len(word.strip(string.punctuation)) > 0 for word in txt.split())
+    characters = len(txt)
+    letters = len(re.sub("[{}]".format(re.escape(string.whitespace + string.punctuation + string.digits)), "", txt))
+    return words, characters, letters
+
+
+def make_text(words, seed=0):
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(0, words, 12):
+        lines.append(" ".join(rnd.choice(SAMPLE_WORDS) for _ in range(12)))
+    return "\n\t".join(lines) + "  "
+
+
+def peak_memory(func, txt):
+    tracemalloc.start()
+    func(txt)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--words", type=int, nargs="+", default=[1_000, 100_000, 500_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for size in args.words:
+        txt = make_text(size)
+        expected = legacy_count_text(txt)
+        assert utils.count_text(txt) == expected, (utils.count_text(txt), expected)
+        print(f"{size} words, {len(txt)} characters:")
+        for name, func in (("legacy", legacy_count_text), ("count_text", utils.count_text)):
+            best = min(timeit.repeat(lambda: func(txt), number=1, repeat=args.repeat))
+            print(f"  {name:>10}: {best * 1000:9.2f} ms, peak {peak_memory(func, txt) / 1024:9.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
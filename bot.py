@@ -5,31 +5,49 @@ Bot to generate writing prompts
 """
 
 import asyncio
+import functools
+import itertools
 import logging
 import os
 import random
 import re
-import string
+import tempfile
+from collections import Counter
 
+import httpx
 import pytz
-from parsel import Selector
-from telegram import Bot, MessageEntity
+from telegram import (
+    Bot,
+    ChatMember,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto,
+    InputTextMessageContent,
+    MessageEntity,
+    Update,
+)
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     AIORateLimiter,
     Application,
     CallbackQueryHandler,
+    ChatMemberHandler,
     CommandHandler,
     Defaults,
+    InlineQueryHandler,
     MessageHandler,
-    PicklePersistence,
     filters,
 )
-from telegraph import Telegraph
+from telegraph.aio import Telegraph
 
+import documents
+import metrics
 import prompts_store
 import utils
+import webhook_workers
 from sprint import *
+from sqlite_persistence import SQLitePersistence
+from update_processor import ChatOrderedUpdateProcessor
 from utils import whitelisted
 
 # Enable logging
@@ -37,13 +55,64 @@ logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s
 
 logger = logging.getLogger(__name__)
 
+TELEGRAPH_CACHE_SIZE = int(os.environ.get("TELEGRAPH_CACHE_SIZE", 256))
+TELEGRAPH_CACHE_TTL = int(os.environ.get("TELEGRAPH_CACHE_TTL", 600))
+CHAT_ADMINS_CACHE_SIZE = int(os.environ.get("CHAT_ADMINS_CACHE_SIZE", 4096))
+CHAT_ADMINS_CACHE_TTL = int(os.environ.get("CHAT_ADMINS_CACHE_TTL", 600))
+# Seconds between checks whether the prompts changed in Google, 0 to check only on startup
+PROMPTS_REFRESH_INTERVAL = int(os.environ.get("PROMPTS_REFRESH_INTERVAL", 0))
+# Updates processed at the same time, updates of one chat are always processed one by one
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 32))
+# Processes handling the webhook updates, each serving its share of the chats
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", 1))
+# Seconds between checks whether another worker process reloaded the prompts
+PROMPTS_FOLLOW_INTERVAL = int(os.environ.get("PROMPTS_FOLLOW_INTERVAL", 5))
+# Chat the images of the most used categories are uploaded to ahead of time, no uploads ahead when unset
+IMAGE_PREWARM_CHAT_ID = os.environ.get("IMAGE_PREWARM_CHAT_ID")
+IMAGE_PREWARM_INTERVAL = int(os.environ.get("IMAGE_PREWARM_INTERVAL", 3600))
+IMAGE_PREWARM_CATEGORIES = int(os.environ.get("IMAGE_PREWARM_CATEGORIES", 3))
+# Images uploaded ahead of time in one run of the job
+IMAGE_PREWARM_BATCH = int(os.environ.get("IMAGE_PREWARM_BATCH", 20))
+# Results in one page of an inline query answer, Telegram takes at most 50
+INLINE_PAGE_SIZE = int(os.environ.get("INLINE_PAGE_SIZE", 20))
+# Pages of random text prompts offered for one inline query
+INLINE_TEXT_PAGES = int(os.environ.get("INLINE_TEXT_PAGES", 5))
+# Seconds Telegram and the bot keep the pages of inline query answers
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300))
+INLINE_CACHE_SIZE = int(os.environ.get("INLINE_CACHE_SIZE", 1024))
+# Largest document /wc counts, the Bot API does not let bots download larger files anyway
+WC_MAX_FILE_SIZE = int(os.environ.get("WC_MAX_FILE_SIZE", 20 * 1024 * 1024))
+WC_DOWNLOAD_TIMEOUT = int(os.environ.get("WC_DOWNLOAD_TIMEOUT", 60))
+WC_CACHE_SIZE = int(os.environ.get("WC_CACHE_SIZE", 1024))
+# A file never changes under its file_unique_id, so its counts can be kept for long
+WC_CACHE_TTL = int(os.environ.get("WC_CACHE_TTL", 24 * 3600))
+PERSISTENCE_FILE = os.environ.get("PERSISTENCE_FILE", "db.sqlite3")
+# Data of the old PicklePersistence, copied into PERSISTENCE_FILE on the first start
+LEGACY_PERSISTENCE_FILE = "db.pickle"
+
 
 class PromptsBot:
-    def __init__(self):
-        self.prompts = prompts_store.PromptsStore()
-        self.super_admins = [int(userid) for userid in os.environ.get("BOT_SUPERADMINS").split(",")]
-        self.help_text = "\n".join(self.prompts.config["help_message"])
+    def __init__(self, prompts=None, worker=None):
+        """`worker` is the number of the worker process in the multi-worker webhook mode"""
+        self.prompts = prompts or prompts_store.PromptsStore()
+        self.worker = worker
+        self.super_admins = {int(userid) for userid in os.environ.get("BOT_SUPERADMINS").split(",")}
+        self.chat_admins_cache = utils.TTLCache(CHAT_ADMINS_CACHE_SIZE, CHAT_ADMINS_CACHE_TTL)
         self.telegraph = Telegraph()
+        self.telegraph_cache = utils.TTLCache(TELEGRAPH_CACHE_SIZE, TELEGRAPH_CACHE_TTL)
+        self.telegraph_requests = {}
+        self.document_counts = utils.TTLCache(WC_CACHE_SIZE, WC_CACHE_TTL)
+        # Telegram file ids of the uploaded images by Drive file id, kept in their own persistence table
+        self.image_file_ids = {}
+        # /image uses by category, saved to bot_data only when the images are prewarmed
+        self.image_category_uses = Counter()
+        # Images that failed to upload ahead of time, left to be uploaded when they are asked for
+        self.prewarm_failures = set()
+        self.inline_cache = utils.TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TIME)
+        # The snapshot the cached inline pages were built from, and the order of the images in them
+        self.inline_snapshot = None
+        self.inline_seed = 0
+        self.sprints = SprintScheduler()
         self.app = None
         self.me = None
         self.bot_username = None
@@ -52,6 +121,49 @@ class PromptsBot:
         self.app = app
         self.me = await self.app.bot.get_me()
         self.bot_username = "@" + self.me.username
+        # Running sprints are kept in bot_data, so that persistence carries them over restarts
+        self.sprints.bot = self.app.bot
+        sprints = self.app.bot_data.setdefault("sprints", {})
+        if self.worker is not None:
+            # Data of a single process bot is copied to every worker, keep only the chats of this one
+            for chat_id in [chat_id for chat_id in sprints if chat_id % WEBHOOK_WORKERS != self.worker]:
+                del sprints[chat_id]
+            if self.prompts.snapshot_file:
+                self.app.job_queue.run_repeating(self.follow_prompts, interval=PROMPTS_FOLLOW_INTERVAL)
+        self.sprints.restore(sprints)
+        self.sprints.start()
+        self.image_file_ids = self.app.persistence.get_image_file_ids()
+        # Older versions kept the file ids in bot_data, which was written whole on every new one
+        for image_id, file_id in self.app.bot_data.pop("image_file_ids", {}).items():
+            if image_id not in self.image_file_ids:
+                self.set_image_file_id(image_id, file_id)
+        self.image_category_uses = self.app.bot_data.get("image_category_uses", Counter()).copy()
+        if IMAGE_PREWARM_CHAT_ID:
+            self.app.job_queue.run_repeating(self.prewarm_images, interval=IMAGE_PREWARM_INTERVAL, first=60)
+        if self.worker:
+            # The first worker keeps the prompts current for all of them
+            return
+        # The prompts may come from the snapshot file, check in the background whether they are still current
+        self.app.job_queue.run_once(self.refresh_prompts, 0)
+        if PROMPTS_REFRESH_INTERVAL:
+            self.app.job_queue.run_repeating(
+                self.refresh_prompts, interval=PROMPTS_REFRESH_INTERVAL, first=PROMPTS_REFRESH_INTERVAL
+            )
+
+    @property
+    def help_text(self):
+        return "\n".join(self.prompts.config["help_message"])
+
+    async def refresh_prompts(self, context):
+        try:
+            await self.prompts.refresh(only_if_stale=True)
+        except Exception:
+            logger.exception("Scheduled prompts reload failed, keeping the previous prompts")
+
+    async def follow_prompts(self, context):
+        """Pick up the prompts reloaded by another worker process"""
+        if await asyncio.to_thread(self.prompts.follow_snapshot):
+            logger.info("Prompts reloaded from snapshot: %s", self.prompts.get_stats())
 
     def check_if_chat_whitelisted(self, chat):
         return True
@@ -67,31 +179,249 @@ class PromptsBot:
 
     @whitelisted()
     async def prompt_command(self, update, context):
-        """Send a message when the command /help is issued."""
-        prompt_string = "\n".join([f"<b>{k}:</b> {v}" for k, v in self.prompts.random_text("ua").items()])
+        """Send a text prompt in the language given by the /prompt_<lang> suffix."""
+        lang = utils.get_command_suffix(update.effective_message, self.bot_username, "/prompt")
+        if lang and "@" in lang:
+            # Addressed to another bot, the username of this one is already cut off
+            return
+        lang = lang[1:] if lang else self.prompts.languages[0]
+        if lang not in self.prompts.languages:
+            return
+        prompt = self.prompts.random_text(lang, context.chat_data.setdefault("prompt_bags", {}))
+        await update.effective_message.reply_html(self.format_prompt(prompt))
+
+    @staticmethod
+    def format_prompt(prompt):
+        return "\n".join([f"<b>{k}:</b> {v}" for k, v in prompt.items()])
 
-        await update.effective_message.reply_html(prompt_string)
+    @staticmethod
+    def format_image_caption(image_prompt):
+        return f"{image_prompt.category} #<a href='{image_prompt.image.link}'>{image_prompt.num}</a>"
 
     @whitelisted()
     async def image_command(self, update, context):
         """Send a message when the command /help is issued."""
-        cat = utils.get_command_suffix(update.effective_message, "/image", self.bot_username)
+        cat = utils.get_command_suffix(update.effective_message, self.bot_username, "/image")
+        if cat and "@" in cat:
+            # Addressed to another bot, the username of this one is already cut off
+            return
         cat = cat[1:] if cat else "all"
 
-        image_prompt = self.prompts.random_image(cat)
-        await update.effective_message.reply_html(
-            f"{image_prompt['cat']} #<a href='{image_prompt['webContentLink']}'>{image_prompt['num']}</a>",
-            disable_web_page_preview=False,
+        image_prompt = self.prompts.random_image(cat, context.chat_data.setdefault("prompt_bags", {}))
+        if image_prompt is None:
+            return
+        self.image_category_uses[image_prompt.category] += 1
+        image = image_prompt.image
+        caption = self.format_image_caption(image_prompt)
+        try:
+            await self.send_image(update.effective_message.reply_photo, image, caption=caption)
+        except Exception:
+            logger.warning("Cannot send image %s, sending the link instead", image.id, exc_info=True)
+            await update.effective_message.reply_html(caption, disable_web_page_preview=False)
+
+    async def send_image(self, send_photo, image, **kwargs):
+        """Send the image with send_photo, uploading it from Drive only the first time"""
+        file_id = self.image_file_ids.get(image.id)
+        if file_id is None:
+            # Another worker process may have uploaded it
+            file_id = self.app.persistence.get_image_file_id(image.id)
+            if file_id is not None:
+                self.image_file_ids[image.id] = file_id
+        if file_id is not None:
+            try:
+                return await send_photo(file_id, **kwargs)
+            except BadRequest:
+                logger.info("File id of image %s is no longer valid, uploading it again", image.id)
+                self.set_image_file_id(image.id, None)
+        message = await send_photo(await self.prompts.download_image(image.id), **kwargs)
+        self.set_image_file_id(image.id, message.photo[-1].file_id)
+        return message
+
+    def set_image_file_id(self, image_id, file_id):
+        """Remember the file id of an image, or forget it for file_id None, written to its own row at once"""
+        if file_id is None:
+            self.image_file_ids.pop(image_id, None)
+        else:
+            self.image_file_ids[image_id] = file_id
+        self.app.persistence.update_image_file_id(image_id, file_id)
+
+    async def prewarm_images(self, context):
+        """Upload the images of the most used categories that were not sent yet, so they are sent at once later"""
+        # Saved here rather than on every /image, so that bot_data is not written on every command
+        context.bot_data["image_category_uses"] = self.image_category_uses.copy()
+        send_photo = functools.partial(context.bot.send_photo, IMAGE_PREWARM_CHAT_ID, disable_notification=True)
+        uploaded = 0
+        images = self.prompts.images
+        for cat, _ in self.image_category_uses.most_common(IMAGE_PREWARM_CATEGORIES):
+            if cat != prompts_store.ImageCatalog.ALL and cat not in images.categories:
+                continue
+            for image in images.folder(cat):
+                if uploaded >= IMAGE_PREWARM_BATCH:
+                    return
+                if image.id in self.image_file_ids or image.id in self.prewarm_failures:
+                    continue
+                try:
+                    message = await self.send_image(send_photo, image)
+                    await message.delete()
+                except Exception:
+                    # Drive errors too, e.g. a deleted file or an exceeded quota
+                    logger.warning("Cannot upload image %s ahead of time", image.id, exc_info=True)
+                    self.prewarm_failures.add(image.id)
+                uploaded += 1
+
+    def inline_text_page(self, lang, page):
+        """A page of random text prompts, the last one is page INLINE_TEXT_PAGES - 1"""
+        results = []
+        for i in range(INLINE_PAGE_SIZE):
+            prompt = self.prompts.random_text(lang)
+            values = list(prompt.values())
+            results.append(
+                InlineQueryResultArticle(
+                    f"{lang}-{page}-{i}",
+                    title=values[0] if values else lang,
+                    description="; ".join(values[1:]),
+                    input_message_content=InputTextMessageContent(self.format_prompt(prompt)),
+                )
+            )
+        return results, str(page + 1) if page + 1 < INLINE_TEXT_PAGES else ""
+
+    def inline_image_page(self, category, page):
+        """A page of the images of the category, in an order shuffled anew for every snapshot.
+        Images already uploaded to Telegram are offered as photos, the others as links"""
+        images = self.prompts.images
+        count = images.count(category)
+        results = []
+        for position in range(page * INLINE_PAGE_SIZE, min((page + 1) * INLINE_PAGE_SIZE, count)):
+            image_prompt = images.get(category, prompts_store.shuffled_index(position, count, self.inline_seed))
+            caption = self.format_image_caption(image_prompt)
+            file_id = self.image_file_ids.get(image_prompt.image.id)
+            if file_id is not None:
+                results.append(InlineQueryResultCachedPhoto(image_prompt.image.id, file_id, caption=caption))
+            else:
+                results.append(
+                    InlineQueryResultArticle(
+                        image_prompt.image.id,
+                        title=f"{category} #{image_prompt.num}",
+                        description=image_prompt.image.name,
+                        input_message_content=InputTextMessageContent(caption, disable_web_page_preview=False),
+                    )
+                )
+        return results, str(page + 1) if (page + 1) * INLINE_PAGE_SIZE < count else ""
+
+    def get_inline_page(self, kind, name, page):
+        """A cached page of inline results with the offset of the next page, built again after a reload"""
+        if self.prompts.snapshot is not self.inline_snapshot:
+            self.inline_cache.clear()
+            self.inline_snapshot = self.prompts.snapshot
+            self.inline_seed = random.getrandbits(32)
+        key = (kind, name, page)
+        cached = self.inline_cache.get(key)
+        if cached is None:
+            build_page = self.inline_text_page if kind == "text" else self.inline_image_page
+            cached = self.inline_cache[key] = build_page(name, page)
+        return cached
+
+    async def inline_query(self, update, context):
+        """Answer with text prompts of the language typed, of the first language for an empty query,
+        or with the images of the category typed"""
+        query = update.inline_query.query.strip().casefold()
+        offset = update.inline_query.offset
+        page = int(offset) if offset.isdigit() else 0
+        if not query or query in self.prompts.languages:
+            results, next_offset = self.get_inline_page("text", query or self.prompts.languages[0], page)
+        else:
+            category = self.prompts.images.resolve(query, self.prompts.image_aliases)
+            results, next_offset = self.get_inline_page("image", category, page) if category else ([], "")
+        await update.inline_query.answer(
+            results, cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset
         )
 
     @whitelisted()
     async def stats_command(self, update, context):
+        stats = self.prompts.get_stats()
+        stats.update({f"telegraph-cache-{k}": v for k, v in self.telegraph_cache.get_stats().items()})
+        stats.update({f"admins-cache-{k}": v for k, v in self.chat_admins_cache.get_stats().items()})
+        stats.update({f"inline-cache-{k}": v for k, v in self.inline_cache.get_stats().items()})
+        stats.update({f"wc-cache-{k}": v for k, v in self.document_counts.get_stats().items()})
+        stats["image-file-ids"] = len(self.image_file_ids)
+        stats["sprints"] = len(self.sprints.sprints)
+        stats["sprint-skipped-edits"] = Sprint.skipped_edits
+        stats.update({f"updates-{k}": v for k, v in context.application.update_processor.get_stats().items()})
         await update.effective_message.reply_html(
-            "\n".join([f"<b>{stat}:</b> {value}" for stat, value in self.prompts.get_stats().items()])
+            "\n".join([f"<b>{stat}:</b> {value}" for stat, value in stats.items()])
         )
 
+    async def fetch_telegraph_page(self, path):
+        with metrics.timed("telegraph", "getPage"):
+            return await self.telegraph.get_page(path, return_content=True, return_html=False)
+
+    async def get_telegraph_page(self, path):
+        """Fetch a Telegraph page without blocking, sharing one request between concurrent callers"""
+        page = self.telegraph_cache.get(path)
+        if page is not None:
+            return page
+        request = self.telegraph_requests.get(path)
+        if request is None:
+            request = asyncio.ensure_future(self.fetch_telegraph_page(path))
+            self.telegraph_requests[path] = request
+            request.add_done_callback(functools.partial(self.telegraph_request_done, path))
+        # A cancelled caller leaves the request running for the others
+        return await asyncio.shield(request)
+
+    def telegraph_request_done(self, path, request):
+        """Cache the fetched page once the shared request ends, whether or not anyone still waits for it"""
+        del self.telegraph_requests[path]
+        if not request.cancelled() and request.exception() is None:
+            self.telegraph_cache[path] = request.result()
+
+    async def download_file(self, file, out):
+        """Download a Telegram file into out chunk by chunk, never holding the whole file in memory"""
+        size = 0
+        with metrics.timed("telegram", "downloadFile"):
+            async with httpx.AsyncClient(timeout=WC_DOWNLOAD_TIMEOUT) as client:
+                async with client.stream("GET", file.file_path) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes(documents.CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > WC_MAX_FILE_SIZE:
+                            raise documents.DocumentError("File is larger than it was said to be")
+                        out.write(chunk)
+
+    async def count_document(self, document, document_format):
+        """Count a document in a worker thread, or take the counts of the same file counted before"""
+        counts = self.document_counts.get(document.file_unique_id)
+        if counts is not None:
+            return counts
+        file = await document.get_file()
+        with tempfile.TemporaryFile() as out:
+            await self.download_file(file, out)
+            out.seek(0)
+            counts = await asyncio.to_thread(documents.count_document, out, document_format, WC_MAX_FILE_SIZE)
+        self.document_counts[document.file_unique_id] = counts
+        return counts
+
     @whitelisted()
     async def wordcount_command(self, update, context):
+        document = (update.effective_message.reply_to_message or update.effective_message).document
+        if document:
+            document_format = documents.get_format(document.file_name, document.mime_type)
+            if document_format is None:
+                await update.effective_message.reply_html("Можу порахувати лише файли txt, md, docx та fb2.")
+                return
+            if (document.file_size or 0) > WC_MAX_FILE_SIZE:
+                await update.effective_message.reply_html(
+                    f"Файл завеликий, можу порахувати файли до {WC_MAX_FILE_SIZE // (1024 * 1024)} МБ."
+                )
+                return
+            try:
+                words, characters, letters = await self.count_document(document, document_format)
+            except (documents.DocumentError, TelegramError, httpx.HTTPError):
+                logger.warning("Cannot count document %s", document.file_unique_id, exc_info=True)
+                await update.effective_message.reply_html("Не вдалося прочитати файл.")
+                return
+            await self.reply_word_count(update, words, characters, letters, "У файлі:\n")
+            return
+
         if update.effective_message.reply_to_message:
             txt = utils.text_or_caption(update.effective_message.reply_to_message)
         else:
@@ -100,25 +430,50 @@ class PromptsBot:
         result = ""
         linked_text = re.search(r":\/\/telegra\.ph\/([\w-]+)", txt)
         if linked_text and linked_text[1]:
-            page = self.telegraph.get_page(linked_text[1], return_content=True, return_html=True)
-            text_elements = Selector(text=page["content"]).css("::text").getall()
-            txt = page["title"] + "<SEPARATOR>" + "<SEPARATOR>".join(text_elements)
-            txt = re.sub(r"(\s|(<SEPARATOR>))+", " ", txt)
-            txt = re.sub(r"<SEPARATOR>", "", txt)
+            page = await self.get_telegraph_page(linked_text[1])
+            # The title is always separated from the content, even on an empty page
+            text_pieces = itertools.chain((page["title"], ""), utils.iter_node_text(page["content"]))
+            words, characters, letters = utils.count_text_pieces(text_pieces)
 
             result = "У Телеграфі:\n"
+        else:
+            words, characters, letters = utils.count_text(txt)
 
-        words = utils.format_numeral_nouns(
-            sum(len(word.strip(string.punctuation)) > 0 for word in txt.split()), ["слово", "слова", "слів"]
-        )
-        characters = utils.format_numeral_nouns(len(txt), ["символ", "символа", "символів"])
-        letters = utils.format_numeral_nouns(
-            len(re.sub("[{}]".format(re.escape(string.whitespace + string.punctuation + string.digits)), "", txt)),
-            ["літера", "літери", "літер"],
-        )
+        await self.reply_word_count(update, words, characters, letters, result)
+
+    async def reply_word_count(self, update, words, characters, letters, result=""):
+        words = utils.format_numeral_nouns(words, ["слово", "слова", "слів"])
+        characters = utils.format_numeral_nouns(characters, ["символ", "символа", "символів"])
+        letters = utils.format_numeral_nouns(letters, ["літера", "літери", "літер"])
         result += f"{words}\n{characters}\n{letters}"
         await update.effective_message.reply_html(result)
 
+    async def get_chat_admins(self, chat):
+        """Ids of the chat administrators, cached until the TTL runs out or a member is promoted or demoted"""
+        admins = self.chat_admins_cache.get(chat.id)
+        if admins is None:
+            admins = frozenset(admin.user.id for admin in await chat.get_administrators())
+            self.chat_admins_cache[chat.id] = admins
+        return admins
+
+    async def is_chat_admin(self, chat, user_id):
+        return chat.type in ["group", "supergroup"] and user_id in await self.get_chat_admins(chat)
+
+    async def chat_member_update(self, update, context):
+        member_update = update.chat_member or update.my_chat_member
+        admin_statuses = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+        if (member_update.old_chat_member.status in admin_statuses) != (
+            member_update.new_chat_member.status in admin_statuses
+        ):
+            self.chat_admins_cache.pop(member_update.chat.id)
+            stats = self.chat_admins_cache.get_stats()
+            logger.info(
+                "Administrators of chat %s changed, admins cache: %d hits, %d misses",
+                member_update.chat.id,
+                stats["hits"],
+                stats["misses"],
+            )
+
     async def debuginfo_command(self, update, context):
         res = f"Чат id: {update.effective_message.chat.id}"
         if self.check_if_chat_whitelisted(update.effective_message.chat):
@@ -128,9 +483,7 @@ class PromptsBot:
         res += f"\nВаш юзер id: {update.effective_message.from_user.id}"
         if update.effective_message.from_user.id in self.super_admins:
             res += " (адмін боту)"
-        if update.effective_message.chat.type in ["group", "supergroup"] and update.effective_message.from_user.id in [
-            admin.user.id for admin in await update.effective_message.chat.get_administrators()
-        ]:
+        if await self.is_chat_admin(update.effective_message.chat, update.effective_message.from_user.id):
             res += " (адмін чату)"
 
         if update.effective_message.reply_to_message:
@@ -141,31 +494,20 @@ class PromptsBot:
                 res += " (інший бот)"
             if update.effective_message.reply_to_message.from_user.id in self.super_admins:
                 res += " (адмін боту)"
-            if update.effective_message.chat.type in [
-                "group",
-                "supergroup",
-            ] and update.effective_message.reply_to_message.from_user.id in [
-                admin.user.id for admin in await update.effective_message.chat.get_administrators()
-            ]:
+            if await self.is_chat_admin(
+                update.effective_message.chat, update.effective_message.reply_to_message.from_user.id
+            ):
                 res += " (адмін чату)"
         await update.effective_message.reply_text(res)
 
     async def start_sprint(self, message, user, duration, delay, context):
         data = Sprint(duration, delay)
         await data.plan_sprint(message, user)
-        job = context.job_queue.run_repeating(
-            data.tick,
-            interval=60,
-            first=delay * 60 + 1,
-            chat_id=message.chat_id,
-            name=f"sprint_{message.chat_id}",
-            data=data,
-        )
-        data.job = job
+        self.sprints.add(data)
 
     @whitelisted()
     async def sprint_command(self, update, context):
-        jobs = context.job_queue.get_jobs_by_name(f"sprint_{update.effective_message.chat_id}")
+        sprint = self.sprints.get(update.effective_message.chat_id)
         try:
             arg = context.args[0]
             duration = int(arg)
@@ -176,7 +518,7 @@ class PromptsBot:
             delay = int(arg)
         except (IndexError, ValueError):
             delay = DEFAULT_SPRINT_DELAY
-        if len(jobs):
+        if sprint:
             await update.effective_message.reply_text("Спринт вже запущено!")
             return
         elif MIN_SPRINT <= duration <= MAX_SPRINT:
@@ -195,7 +537,7 @@ class PromptsBot:
             return
 
     async def repeat_last_sprint(self, update, context):
-        jobs = context.job_queue.get_jobs_by_name(f"sprint_{update.callback_query.message.chat_id}")
+        sprint = self.sprints.get(update.callback_query.message.chat_id)
         data_match = re.match(r"^repeat_last_sprint_(\d+)(_\d+)?$", update.callback_query.data)
         try:
             duration = int(data_match[1])
@@ -206,7 +548,7 @@ class PromptsBot:
         except (IndexError, ValueError, TypeError):
             delay = DEFAULT_SPRINT_DELAY
 
-        if len(jobs):
+        if sprint:
             await update.callback_query.answer("Спринт вже запущено!")
             return
         elif MIN_SPRINT <= duration <= MAX_SPRINT:
@@ -227,76 +569,96 @@ class PromptsBot:
             return
 
     async def add_user_to_sprint(self, update, context):
-        chat_id = update.callback_query.message.chat_id
-        jobs = context.job_queue.get_jobs_by_name(f"sprint_{chat_id}")
-        if len(jobs):
-            await jobs[0].data.add_user(update.callback_query)
+        sprint = self.sprints.get(update.callback_query.message.chat_id)
+        if sprint:
+            await sprint.add_user(update.callback_query)
         else:
             await update.callback_query.answer("Не можна додатися до цього спринту!")
 
     async def leave_or_cancel_sprint(self, update, context):
-        chat_id = update.callback_query.message.chat_id
-        jobs = context.job_queue.get_jobs_by_name(f"sprint_{chat_id}")
-        if len(jobs):
-            await jobs[0].data.leave_or_cancel_sprint(update.callback_query)
+        sprint = self.sprints.get(update.callback_query.message.chat_id)
+        if sprint:
+            await sprint.leave_or_cancel_sprint(update.callback_query, self.is_chat_admin)
         else:
             await update.callback_query.answer("Не можна вийти з цього спринту!")
 
     @whitelisted(show_error_message=True)
     async def reload_command(self, update, context):
-        if update.effective_message.from_user.id in [self.super_admins] or (
-            update.effective_message.chat.type in ["group", "supergroup"]
-            and update.effective_message.from_user.id
-            in [admin.user.id for admin in await update.effective_message.chat.get_administrators()]
+        if update.effective_message.from_user.id in self.super_admins or await self.is_chat_admin(
+            update.effective_message.chat, update.effective_message.from_user.id
         ):
-            app = self.app
-            self.__init__()
-            await self.set_app(app)
+            try:
+                await self.prompts.refresh()
+            except Exception:
+                logger.exception("Prompts reload failed, keeping the previous prompts")
+                await update.effective_message.reply_text("Не вдалося перезавантажити, залишено попередні дані.")
+                return
             await update.effective_message.reply_text("Перезавантажено!")
 
 
-def main():
-    """Start the bot."""
-    persistence = PicklePersistence(filepath="db.pickle")
-
-    bot_logic = PromptsBot()
-    app = (
+def build_app(prompts, worker=None, request=None, rate_limit=True):
+    """Build the application of the given worker process, or of the only process for worker None.
+    Benchmarks pass a fake `request` to the Bot API, and may turn the rate limiter off"""
+    bot_logic = PromptsBot(prompts, worker)
+    builder = (
         Application.builder()
         .token(os.environ["TELEGRAM_TOKEN"])
-        .persistence(persistence)
-        .rate_limiter(AIORateLimiter())
+        .request(request or metrics.TimedHTTPXRequest(connection_pool_size=256))
+        .persistence(SQLitePersistence(PERSISTENCE_FILE, shard=worker))
+        .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
         .defaults(
             Defaults(parse_mode=ParseMode.HTML, allow_sending_without_reply=True, tzinfo=pytz.timezone("Europe/Kiev"))
         )
         .post_init(bot_logic.set_app)
-        .build()
     )
+    if rate_limit:
+        builder = builder.rate_limiter(AIORateLimiter())
+    app = builder.build()
 
     # on different commands - answer in Telegram
     app.add_handler(CommandHandler("start", bot_logic.start))
     app.add_handler(CommandHandler("help", bot_logic.help_command))
-    app.add_handler(CommandHandler(["prompt", "prompt_ua"], bot_logic.prompt_command))
+    # /prompt_<lang> for every language in the config, which can change on reload, in any case like CommandHandler
+    app.add_handler(MessageHandler(filters.Regex(r"(?i)^/prompt(_\w+)?(@\w+)?(\s|$)"), bot_logic.prompt_command))
     app.add_handler(CommandHandler("wc", bot_logic.wordcount_command))
     app.add_handler(CommandHandler("stats", bot_logic.stats_command))
     app.add_handler(CommandHandler("reload", bot_logic.reload_command))
     app.add_handler(CommandHandler("debuginfo", bot_logic.debuginfo_command))
     app.add_handler(CommandHandler("sprint", bot_logic.sprint_command))
+    app.add_handler(ChatMemberHandler(bot_logic.chat_member_update, ChatMemberHandler.ANY_CHAT_MEMBER))
     app.add_handler(CallbackQueryHandler(bot_logic.add_user_to_sprint, pattern=r"^join_sprint$"))
     app.add_handler(CallbackQueryHandler(bot_logic.leave_or_cancel_sprint, pattern=r"^leave_or_cancel_sprint$"))
     app.add_handler(CallbackQueryHandler(bot_logic.repeat_last_sprint, pattern=r"^repeat_last_sprint_(\d+)(_\d+)?$"))
-    app.add_handler(
-        CommandHandler(["image", "image_character", "image_location", "image_other"], bot_logic.image_command)
-    )
-    # Start the Bot
+    # /image_<category> for every image folder, its aliases and prefixes, which can change on reload, in any case
+    app.add_handler(MessageHandler(filters.Regex(r"(?i)^/image(_\w+)?(@\w+)?(\s|$)"), bot_logic.image_command))
+    app.add_handler(InlineQueryHandler(bot_logic.inline_query))
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.instrument(handler.callback)
+    return app
+
 
+def main():
+    """Start the bot."""
+    if os.path.exists(LEGACY_PERSISTENCE_FILE) and not os.path.exists(PERSISTENCE_FILE):
+        SQLitePersistence(PERSISTENCE_FILE).migrate_from_pickle(LEGACY_PERSISTENCE_FILE)
+
+    # Loaded once here and shared with the forked workers
+    prompts = prompts_store.PromptsStore()
+
+    # Start the Bot
     if os.environ.get("TEST_ENV"):
-        app.run_polling()
+        build_app(prompts).run_polling(allowed_updates=Update.ALL_TYPES)
     else:
-        app.run_webhook(
-            listen="0.0.0.0",
+        webhook_workers.run_webhook(
+            functools.partial(build_app, prompts),
+            WEBHOOK_WORKERS,
+            listen_address="0.0.0.0",
             port=80,
+            token=os.environ["TELEGRAM_TOKEN"],
             webhook_url=f"https://{os.environ.get('HOSTNAME')}/",
             secret_token=os.environ.get("TELEGRAM_WEBHOOK_TOKEN"),
+            allowed_updates=Update.ALL_TYPES,
         )
 
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Word counts of the documents writers send: plain text, Markdown, DOCX and FB2, read and counted in chunks
+"""
+
+import codecs
+import os
+import xml.sax
+import xml.sax.handler
+import zipfile
+
+import utils
+
+CHUNK_SIZE = 1 << 16
+# The XML inside a DOCX may be this many times larger than the file itself
+MAX_UNPACKED_RATIO = 20
+FORMATS = {
+    "txt": "text/plain",
+    "md": "text/markdown",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "fb2": "application/x-fictionbook+xml",
+}
+
+
+class DocumentError(ValueError):
+    """The document is broken or too large to count"""
+
+
+def get_format(file_name, mime_type):
+    """The format of a document by its extension or MIME type, None if it cannot be counted"""
+    extension = os.path.splitext(file_name or "")[1].lower().lstrip(".")
+    if extension in FORMATS:
+        return extension
+    return next((name for name, mime in FORMATS.items() if mime == mime_type), None)
+
+
+def read_chunks(file):
+    return iter(lambda: file.read(CHUNK_SIZE), b"")
+
+
+def count_plain_text(file):
+    """Decode the text as UTF-16 if it starts with its BOM, else as UTF-8, falling back to Windows-1251"""
+    start = file.read(2)
+    if start in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        encodings = [("utf-16", "replace")]
+    else:
+        encodings = [("utf-8-sig", "strict"), ("cp1251", "replace")]
+    for encoding, errors in encodings:
+        file.seek(0)
+        counter = utils.TextCounter()
+        decoder = codecs.getincrementaldecoder(encoding)(errors)
+        try:
+            for chunk in read_chunks(file):
+                counter.feed(decoder.decode(chunk))
+            counter.feed(decoder.decode(b"", final=True))
+        except UnicodeDecodeError:
+            continue
+        return counter.counts
+
+
+class TextHandler(xml.sax.handler.ContentHandler):
+    """Count the text of the `text` elements inside the `body` element, starting every block on a new line.
+    The `separators` elements stand for the given text where they appear inside a `runs` element"""
+
+    def __init__(self, counter, text, blocks, separators=None, runs=()):
+        super().__init__()
+        self.counter = counter
+        self.text = text
+        self.blocks = blocks
+        self.separators = separators or {}
+        self.runs = runs
+        self.body_depth = 0
+        self.text_depth = 0
+        self.run_depth = 0
+        self.seen_block = False
+
+    def startElementNS(self, name, qname, attrs):
+        local_name = name[1]
+        if local_name == "body":
+            self.body_depth += 1
+        if not self.body_depth:
+            return
+        if local_name in self.blocks:
+            if self.seen_block:
+                self.counter.feed("\n")
+            self.seen_block = True
+        if local_name in self.text:
+            self.text_depth += 1
+        if local_name in self.runs:
+            self.run_depth += 1
+        if self.run_depth and local_name in self.separators:
+            self.counter.feed(self.separators[local_name])
+
+    def endElementNS(self, name, qname):
+        local_name = name[1]
+        if local_name == "body":
+            self.body_depth -= 1
+        elif self.body_depth and local_name in self.text:
+            self.text_depth -= 1
+        elif self.body_depth and local_name in self.runs:
+            self.run_depth -= 1
+
+    def characters(self, content):
+        if self.text_depth:
+            self.counter.feed(content)
+
+
+def count_xml(file, **handler_kwargs):
+    counter = utils.TextCounter()
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setContentHandler(TextHandler(counter, **handler_kwargs))
+    try:
+        for chunk in read_chunks(file):
+            parser.feed(chunk)
+        parser.close()
+    except xml.sax.SAXException as e:
+        raise DocumentError(str(e)) from e
+    return counter.counts
+
+
+def count_docx(file, max_size):
+    try:
+        with zipfile.ZipFile(file) as archive:
+            info = archive.getinfo("word/document.xml")
+            if info.file_size > max_size * MAX_UNPACKED_RATIO:
+                raise DocumentError("Unpacked document is too large")
+            with archive.open(info) as document:
+                # The text of a run is in <w:t>, deleted text and field codes are left out.
+                # Tabs and breaks count only inside runs, <w:tab> also defines the tab stops of a paragraph
+                return count_xml(
+                    document,
+                    text={"t"},
+                    blocks={"p"},
+                    separators={"tab": "\t", "br": "\n", "cr": "\n"},
+                    runs={"r"},
+                )
+    except (zipfile.BadZipFile, KeyError, NotImplementedError, RuntimeError) as e:
+        # NotImplementedError for an unsupported compression method, RuntimeError for an encrypted entry
+        raise DocumentError(str(e)) from e
+
+
+def count_fb2(file):
+    # Only the book itself, without the description and the binaries of the images
+    text = {"p", "v", "subtitle", "text-author", "td", "th"}
+    return count_xml(file, text=text, blocks=text)
+
+
+def count_document(file, document_format, max_size):
+    """Count words, characters and letters of a binary file open for reading, like utils.count_text.
+    The file is read in chunks, so memory use does not grow with its size"""
+    if document_format == "docx":
+        return count_docx(file, max_size)
+    if document_format == "fb2":
+        return count_fb2(file)
+    return count_plain_text(file)
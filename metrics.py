@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency histograms of the handlers and of the calls to Google, Telegraph and Telegram, in the Prometheus text format
+"""
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+HANDLER = "handler"
+
+# (service, name) -> [count per bucket..., count above the last bucket, total seconds, errors]
+# The service is HANDLER for the bot's own handlers
+_histograms = {}
+# Google calls are made from worker threads
+_lock = threading.Lock()
+
+
+def observe(service, name, seconds, error=False):
+    with _lock:
+        histogram = _histograms.get((service, name))
+        if histogram is None:
+            histogram = _histograms[(service, name)] = [0] * (len(BUCKETS) + 3)
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-2] += seconds
+        histogram[-1] += error
+
+
+@contextmanager
+def timed(service, name):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        observe(service, name, time.perf_counter() - start, error=True)
+        raise
+    observe(service, name, time.perf_counter() - start)
+
+
+def instrument(callback):
+    """Wrap a handler callback to record its latency and errors"""
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with timed(HANDLER, callback.__name__):
+            return await callback(update, context)
+
+    return wrapper
+
+
+class TimedHTTPXRequest(HTTPXRequest):
+    """Records the latency of every Bot API call, without the time spent waiting for the rate limiter"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        with timed("telegram", url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+
+
+def get_snapshot():
+    with _lock:
+        return {key: list(histogram) for key, histogram in _histograms.items()}
+
+
+def merge(snapshots):
+    """Add up the snapshots of several worker processes"""
+    merged = {}
+    for snapshot in snapshots:
+        for key, histogram in snapshot.items():
+            if key in merged:
+                merged[key] = [a + b for a, b in zip(merged[key], histogram)]
+            else:
+                merged[key] = list(histogram)
+    return merged
+
+
+def render(snapshot):
+    lines = []
+    for family, labels in (("bot_handler", 'handler="{1}"'), ("bot_external_call", 'service="{0}",call="{1}"')):
+        keys = sorted(key for key in snapshot if (key[0] == HANDLER) == (family == "bot_handler"))
+        if not keys:
+            continue
+        lines.append(f"# TYPE {family}_seconds histogram")
+        for key in keys:
+            histogram, label = snapshot[key], labels.format(*key)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram):
+                cumulative += count
+                lines.append(f'{family}_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{family}_seconds_sum{{{label}}} {histogram[-2]:.6f}")
+            lines.append(f"{family}_seconds_count{{{label}}} {cumulative}")
+        lines.append(f"# TYPE {family}_errors_total counter")
+        for key in keys:
+            lines.append(f"{family}_errors_total{{{labels.format(*key)}}} {snapshot[key][-1]}")
+    return "\n".join(lines) + "\n"
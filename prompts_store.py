@@ -1,19 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import asyncio
 import base64
 import logging
 import os
 import os.path
 import pickle
 import random
-from collections import defaultdict
+import sys
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import httplib2
 from apiclient.discovery import build
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 
+import metrics
+
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 
 CLIENT_CONFIG = {
@@ -27,13 +36,130 @@ CLIENT_CONFIG = {
     }
 }
 
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = os.environ.get("PROMPTS_SNAPSHOT_FILE", "prompts_snapshot.pickle")
+SNAPSHOT_VERSION = 4
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+DEFAULT_LANGUAGES = ["ua"]
+# Columns of the База-<lang> sheets that hold the prompts, one column with a header per kind of prompt
+PROMPT_COLUMNS = os.environ.get("PROMPT_COLUMNS", "B:E")
+DRIVE_LIST_WORKERS = int(os.environ.get("DRIVE_LIST_WORKERS", 8))
+
+# Everything loaded from Google at once; replaced as a whole, never modified in place
+PromptsSnapshot = namedtuple("PromptsSnapshot", ["config", "prompts", "images"])
+# What the snapshot was loaded from: the spreadsheet version, the Drive changes feed position and the image folders
+SyncState = namedtuple("SyncState", ["spreadsheet_modified_time", "changes_token", "folder_ids"])
+
+
+# A Drive image file, with only the fields the bot needs
+Image = namedtuple("Image", ["id", "name", "link"])
+# An image picked for a chat, with its category and its number in the category
+ImagePrompt = namedtuple("ImagePrompt", ["category", "num", "image"])
+
+
+def shuffled_index(position, size, seed):
+    """The element at position of the random permutation of range(size) chosen by seed, without building it.
+    A small Feistel network permutes the next power of 4, walking the cycle until the result is in range"""
+    if size <= 1:
+        return 0
+    half = ((size - 1).bit_length() + 1) // 2
+    mask = (1 << half) - 1
+    x = position
+    while True:
+        left, right = x >> half, x & mask
+        for round_number in range(4):
+            mixed = ((right + seed + round_number) * 0x9E3779B1 ^ seed >> round_number) * 0x85EBCA6B
+            left, right = right, left ^ (mixed >> 16) & mask
+        x = left << half | right
+        if x < size:
+            return x
+
+
+def draw(bags, key, size, rnd=random):
+    """The next index of a shuffle bag over a list of size items, so no item repeats until all were drawn.
+    A bag is kept in bags as (seed, size, cursor) and starts over with a new seed when it is used up
+    or when the list changed size on reload"""
+    seed, bag_size, cursor = bags.get(key, (0, -1, 0))
+    if bag_size != size or cursor >= size:
+        seed, cursor = rnd.getrandbits(32), 0
+    bags[key] = (seed, size, cursor + 1)
+    return shuffled_index(cursor, size, seed)
+
+
+def make_image(file_id, file):
+    return Image(file_id, sys.intern(file.get("name") or ""), file.get("webContentLink"))
+
+
+class ImageCatalog:
+    """The images of all categories in one tuple, every category a range of it, so "all" is the whole tuple.
+    Never changed once built, a reload builds a new catalog"""
+
+    ALL = "all"
+    __slots__ = ("images", "ranges")
+
+    def __init__(self, folders=None):
+        """folders maps every category to its images, in the order of the catalog"""
+        images = []
+        self.ranges = {}
+        for category, folder_images in (folders or {}).items():
+            self.ranges[category] = (len(images), len(images) + len(folder_images))
+            images.extend(folder_images)
+        self.images = tuple(images)
+
+    def __eq__(self, other):
+        return isinstance(other, ImageCatalog) and self.ranges == other.ranges and self.images == other.images
+
+    @property
+    def categories(self):
+        return list(self.ranges)
+
+    def _range(self, category):
+        return (0, len(self.images)) if category == self.ALL else self.ranges[category]
+
+    def folder(self, category):
+        start, end = self._range(category)
+        return self.images[start:end]
+
+    def count(self, category):
+        start, end = self._range(category)
+        return end - start
+
+    def get(self, category, num):
+        """The image number num of the category"""
+        start, _ = self._range(category)
+        return ImagePrompt(category, num, self.images[start + num])
+
+    def resolve(self, name, aliases=None):
+        """The category for what the user typed: the category itself, an alias of it or a prefix of only it,
+        in any case. None if there is no such category"""
+        name = name.casefold()
+        if name == self.ALL or name in self.ranges:
+            return name
+        for alias, category in (aliases or {}).items():
+            if alias.casefold() == name and category.casefold() in self.ranges:
+                return category.casefold()
+        matches = [category for category in self.ranges if category.startswith(name)]
+        return matches[0] if len(matches) == 1 else None
+
+    def sample(self, category, bags=None, rnd=random):
+        """A random image of the category, None if it has no images. With the shuffle bags of a chat
+        no image repeats in the chat until all images of the category were sent"""
+        start, end = self._range(category)
+        if start == end:
+            return None
+        if bags is None:
+            index = rnd.randrange(start, end)
+        else:
+            index = start + draw(bags, ("image", category), end - start, rnd)
+        return ImagePrompt(category, index - start, self.images[index])
+
 
 class PromptsStore:
     spreadsheet_id = os.environ.get("SPREADSHEET_ID")
     base_folder_id = os.environ.get("GOOGLE_DRIVE_BASE_FOLDER_ID")
-    prompts = {}
 
-    def _load_bot_config(self):
+    def _parse_bot_config(self, columns):
         def _row_to_key_val(row):
             if len(row) == 4:
                 return row[0], row[1], row[3]
@@ -42,65 +168,187 @@ class PromptsStore:
             else:
                 raise ValueError("Config is missing a value!")
 
-        self.config = defaultdict(str)
-        sheet = self.sheets_service.spreadsheets()
+        config = defaultdict(str)
+        # The config sheet is read by columns together with the prompts, turn it back into rows
+        configs = []
+        for i in range(max(map(len, columns), default=0)):
+            row = [col[i] if i < len(col) else "" for col in columns]
+            while row and not row[-1]:
+                row.pop()
+            configs.append(row)
 
-        configs = (
-            sheet.values()
-            .get(
-                spreadsheetId=self.spreadsheet_id,
-                range=f"{os.environ.get('CONFIG_SHEET_NAME')}!A2:Z",
-                majorDimension="ROWS",
-            )
-            .execute()
-            .get("values", [])
-        )
         for conf in configs:
             key, subkey, val = _row_to_key_val(conf)
-            if key in self.config.keys():
-                if type(self.config[key]) is dict:
-                    self.config[key][subkey] = val
+            if key in config.keys():
+                if type(config[key]) is dict:
+                    config[key][subkey] = val
                 else:
-                    oldkey, oldval = _row_to_key_val(self.config[key])
-                    self.config[key] = {oldkey: oldval, subkey: val}
+                    oldkey, oldval = _row_to_key_val(config[key])
+                    config[key] = {oldkey: oldval, subkey: val}
             elif subkey:
-                self.config[key] = {subkey: val}
+                config[key] = {subkey: val}
             else:
-                self.config[key] = val
+                config[key] = val
+        return config
 
-    def _load_text_prompts(self):
-        sheet = self.sheets_service.spreadsheets()
+    def _parse_text_prompts(self, columns):
+        # Columns without a header or without prompts are left out
+        return {col[0]: col[1:] for col in columns if len(col) > 1 and col[0]}
+
+    @staticmethod
+    def _get_languages(config):
+        languages = config.get("languages") or DEFAULT_LANGUAGES
+        if isinstance(languages, str):
+            languages = languages.split(",")
+        languages = [lang.strip().lower() for lang in languages if lang.strip()]
+        return languages or DEFAULT_LANGUAGES
+
+    def _batch_get(self, ranges):
+        result = self._execute(
+            self.sheets_service.spreadsheets()
+            .values()
+            .batchGet(spreadsheetId=self.spreadsheet_id, ranges=ranges, majorDimension="COLUMNS")
+        )
+        return [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
 
-        for lang in ["ua"]:
-            self.prompts[lang] = {}
-            result = (
-                sheet.values()
-                .get(spreadsheetId=self.spreadsheet_id, range=f"База-{lang}!B1:E", majorDimension="COLUMNS")
-                .execute()
+    def _load_sheets(self):
+        """Read the config and the prompts of every language in a single request.
+        The languages are the ones configured so far; newly configured ones take one more request"""
+        languages = self._get_languages(self.config) if self.snapshot else DEFAULT_LANGUAGES
+        config_range = f"{os.environ.get('CONFIG_SHEET_NAME')}!A2:Z"
+        config_values, *prompt_values = self._batch_get(
+            [config_range] + [f"База-{lang}!{PROMPT_COLUMNS}" for lang in languages]
+        )
+        config = self._parse_bot_config(config_values)
+        prompts = dict(zip(languages, map(self._parse_text_prompts, prompt_values)))
+
+        missing = [lang for lang in self._get_languages(config) if lang not in prompts]
+        if missing:
+            prompt_values = self._batch_get([f"База-{lang}!{PROMPT_COLUMNS}" for lang in missing])
+            prompts.update(zip(missing, map(self._parse_text_prompts, prompt_values)))
+        return config, {lang: prompts[lang] for lang in self._get_languages(config)}
+
+    def _execute(self, request):
+        """Execute a Google API request over a connection of the current thread, as httplib2 is not thread-safe"""
+        with metrics.timed("google", getattr(request, "methodId", "request")):
+            if self._credentials is None:
+                return request.execute()
+            http = getattr(self._thread_local, "http", None)
+            if http is None:
+                http = self._thread_local.http = AuthorizedHttp(self._credentials, http=httplib2.Http())
+            return request.execute(http=http)
+
+    def _list_files(self, query, fields):
+        """List all Drive files matching the query, following every result page"""
+        files = []
+        page_token = None
+        while True:
+            response = self._execute(
+                self.drive_service.list(
+                    pageSize=1000, pageToken=page_token, q=query, fields=f"nextPageToken, files({fields})"
+                )
             )
-            prompts = result.get("values", [])
-            for col in prompts:
-                self.prompts[lang][col[0]] = col[1:]
+            files += response.get("files", [])
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return files
+
+    def _list_folders(self, fields="id, name"):
+        return self._list_files(
+            f"'{self.base_folder_id}' in parents and mimeType = '{FOLDER_MIME_TYPE}' and trashed = false", fields
+        )
+
+    def _list_images(self, folder):
+        start = time.perf_counter()
+        files = self._list_files(
+            f"'{folder['id']}' in parents and mimeType contains 'image/' and trashed = false",
+            "id, name, webContentLink",
+        )
+        logger.info("Listed %d images in folder %s in %.2fs", len(files), folder["name"], time.perf_counter() - start)
+        return [make_image(file["id"], file) for file in files]
 
     def _load_image_prompts(self):
-        self.folders = {"all": []}
-        folders = self.drive_service.list(
-            q=f"'{self.base_folder_id}' in parents and mimeType = 'application/vnd.google-apps.folder'",
-            fields="files(id, name)",
-        ).execute()
-        for folder in folders.get("files", []):
+        folders = []
+        for folder in self._list_folders():
             folder["name"] = folder["name"].lower()
-            if folder["name"] != "all" and folder["id"] != self.base_folder_id:
-                images = self.drive_service.list(
+            if folder["name"] != ImageCatalog.ALL and folder["id"] != self.base_folder_id:
+                folders.append(folder)
+        with ThreadPoolExecutor(max_workers=DRIVE_LIST_WORKERS) as executor:
+            images = dict(zip((folder["name"] for folder in folders), executor.map(self._list_images, folders)))
+        return ImageCatalog(images), {folder["id"]: folder["name"] for folder in folders}
+
+    def _list_drive_changes(self, page_token):
+        """Return the Drive changes since page_token and the token to continue from next time"""
+        changes = []
+        while True:
+            response = self._execute(
+                self.changes_service.list(
+                    pageToken=page_token,
                     pageSize=1000,
-                    q=f"'{folder['id']}' in parents and mimeType contains 'image/'",
-                    fields="files(id, name, webContentLink)",
-                ).execute()["files"]
-                self.folders[folder["name"]] = images
-                self.folders["all"] += images
-
-    def __init__(self):
-        """Connect to google sheet and loads the prompt"""
+                    includeRemoved=True,
+                    fields="nextPageToken, newStartPageToken, "
+                    "changes(fileId, removed, file(name, mimeType, parents, trashed, webContentLink))",
+                )
+            )
+            changes += response.get("changes", [])
+            if "newStartPageToken" in response:
+                return changes, response["newStartPageToken"]
+            page_token = response["nextPageToken"]
+
+    def _apply_image_changes(self, changes):
+        """Return the image catalog with the added, removed and renamed images applied,
+        or None if a category folder itself changed and the images have to be listed again"""
+        folder_ids = self.sync.folder_ids
+        folder_of_image = {image.id: name for name in self.images.categories for image in self.images.folder(name)}
+        updated = {}
+        for change in changes:
+            file = change.get("file") or {}
+            if change["fileId"] in folder_ids or (
+                file.get("mimeType") == FOLDER_MIME_TYPE and self.base_folder_id in file.get("parents", [])
+            ):
+                return None
+            old_folder = folder_of_image.get(change["fileId"])
+            new_folder = None
+            if not (change.get("removed") or file.get("trashed")) and file.get("mimeType", "").startswith("image/"):
+                new_folder = next((folder_ids[p] for p in file.get("parents", []) if p in folder_ids), None)
+            if old_folder is None and new_folder is None:
+                continue
+
+            image = make_image(change["fileId"], file)
+            if old_folder is not None:
+                images = updated.setdefault(old_folder, list(self.images.folder(old_folder)))
+                index = next(i for i, old_image in enumerate(images) if old_image.id == change["fileId"])
+                if old_folder == new_folder:
+                    images[index] = image
+                    continue
+                del images[index]
+                del folder_of_image[change["fileId"]]
+            if new_folder is not None:
+                updated.setdefault(new_folder, list(self.images.folder(new_folder))).append(image)
+                folder_of_image[change["fileId"]] = new_folder
+
+        if not updated:
+            return self.images
+        return ImageCatalog(
+            {name: updated[name] if name in updated else self.images.folder(name) for name in folder_ids.values()}
+        )
+
+    def __init__(self, sheets_service=None, drive_service=None, changes_service=None, snapshot_file=SNAPSHOT_FILE):
+        """Serve the prompts from the snapshot file if there is one, otherwise load them from Google"""
+        self.sheets_service = sheets_service
+        self.drive_service = drive_service
+        self.changes_service = changes_service
+        self.snapshot_file = snapshot_file
+        self._credentials = None
+        self._thread_local = threading.local()
+        self.snapshot = None
+        self.sync = None
+        self.snapshot_mtime = None
+        self._refresh_lock = asyncio.Lock()
+        if not self._read_snapshot():
+            self.load()
+
+    def _connect(self):
         creds = None
         logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
         # The file token.pickle stores the user's access and refresh tokens, and is
@@ -123,31 +371,142 @@ class PromptsStore:
             with open("token.pickle.b64", "wb") as token_file:
                 token_file.write(base64.b64encode(pickle.dumps(creds)))
 
-        self.drive_service = build("drive", "v3", credentials=creds).files()
+        self._credentials = creds
+        drive = build("drive", "v3", credentials=creds)
+        self.drive_service = drive.files()
+        self.changes_service = drive.changes()
         self.sheets_service = build("sheets", "v4", credentials=creds)
 
-        self._load_bot_config()
-        self._load_text_prompts()
-        self._load_image_prompts()
+    def _get_spreadsheet_modified_time(self):
+        return self._execute(self.drive_service.get(fileId=self.spreadsheet_id, fields="modifiedTime"))["modifiedTime"]
+
+    def _read_snapshot(self):
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return False
+        try:
+            with open(self.snapshot_file, "rb") as snapshot_file:
+                saved = pickle.load(snapshot_file)
+            if saved["version"] != SNAPSHOT_VERSION:
+                return False
+            self.snapshot = PromptsSnapshot(*saved["snapshot"])
+            self.sync = SyncState(*saved["sync"])
+            self.snapshot_mtime = os.fstat(snapshot_file.fileno()).st_mtime_ns
+        except Exception:
+            logger.exception("Cannot read prompts snapshot %s", self.snapshot_file)
+            return False
+        logger.info("Prompts loaded from snapshot %s", self.snapshot_file)
+        return True
+
+    def _write_snapshot(self):
+        if not self.snapshot_file:
+            return
+        saved = {"version": SNAPSHOT_VERSION, "sync": tuple(self.sync), "snapshot": tuple(self.snapshot)}
+        # Several worker processes may write the snapshot at once
+        tmp_file = f"{self.snapshot_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as snapshot_file:
+            pickle.dump(saved, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot_file.flush()
+            self.snapshot_mtime = os.fstat(snapshot_file.fileno()).st_mtime_ns
+        os.replace(tmp_file, self.snapshot_file)
+
+    def follow_snapshot(self):
+        """Read the snapshot file again if another process wrote it. Returns whether the prompts changed"""
+        if not self.snapshot_file:
+            return False
+        try:
+            mtime = os.stat(self.snapshot_file).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self.snapshot_mtime:
+            return False
+        snapshot = self.snapshot
+        return self._read_snapshot() and self.snapshot != snapshot
+
+    def load(self, only_if_stale=False):
+        """Load the prompts from Google and swap them in at once, keeping the old data if loading fails.
+        With only_if_stale the sheets are read only if the spreadsheet changed, and only the Drive changes
+        since the last load are applied to the images. Returns whether the prompts changed"""
+        if self.sheets_service is None or self.drive_service is None or self.changes_service is None:
+            self._connect()
+        spreadsheet_modified_time = self._get_spreadsheet_modified_time()
+        if only_if_stale and self.sync is not None:
+            changes, changes_token = self._list_drive_changes(self.sync.changes_token)
+            images, folder_ids = self._apply_image_changes(changes), self.sync.folder_ids
+            if images is None:
+                images, folder_ids = self._load_image_prompts()
+            if spreadsheet_modified_time != self.sync.spreadsheet_modified_time:
+                snapshot = PromptsSnapshot(*self._load_sheets(), images)
+            else:
+                snapshot = self.snapshot._replace(images=images)
+            changed = snapshot != self.snapshot
+        else:
+            # Take the changes token first, so nothing changed during the load is missed
+            changes_token = self._execute(self.changes_service.getStartPageToken())["startPageToken"]
+            images, folder_ids = self._load_image_prompts()
+            snapshot = PromptsSnapshot(*self._load_sheets(), images)
+            changed = True
+        sync = SyncState(spreadsheet_modified_time, changes_token, folder_ids)
+        if changed or sync != self.sync:
+            self.snapshot, self.sync = snapshot, sync
+            self._write_snapshot()
+        return changed
+
+    async def refresh(self, only_if_stale=False):
+        """Reload the prompts in a worker thread, so that handlers keep serving the current snapshot"""
+        async with self._refresh_lock:
+            reloaded = await asyncio.to_thread(self.load, only_if_stale)
+        if reloaded:
+            logger.info("Prompts reloaded: %s", self.get_stats())
+        return reloaded
+
+    def _download_image(self, file_id):
+        if self.drive_service is None:
+            self._connect()
+        return self._execute(self.drive_service.get_media(fileId=file_id))
+
+    async def download_image(self, file_id):
+        """Download the contents of an image file from Drive in a worker thread"""
+        return await asyncio.to_thread(self._download_image, file_id)
+
+    @property
+    def config(self):
+        return self.snapshot.config
+
+    @property
+    def prompts(self):
+        return self.snapshot.prompts
+
+    @property
+    def images(self):
+        return self.snapshot.images
+
+    @property
+    def image_aliases(self):
+        """Other names of the image categories, from the image_aliases rows of the config"""
+        aliases = self.config.get("image_aliases")
+        return aliases if isinstance(aliases, dict) else {}
 
-    def random_text(self, lang):
-        return {k: random.choice(v) for k, v in self.prompts[lang].items()}
+    @property
+    def languages(self):
+        return list(self.snapshot.prompts)
 
-    def random_image(self, cat):
-        if cat not in self.folders.keys():
-            cat = "all"
-        num = random.randint(0, len(self.folders[cat]) - 1)
-        image_prompt = self.folders[cat][num]
-        image_prompt["cat"] = cat
-        image_prompt["num"] = num
+    def random_text(self, lang, bags=None):
+        """A random prompt of every column. With the shuffle bags of a chat, see draw(),
+        no prompt of a column repeats in the chat until the whole column was used"""
+        if bags is None:
+            return {k: random.choice(v) for k, v in self.prompts[lang].items()}
+        return {k: v[draw(bags, ("text", lang, k), len(v))] for k, v in self.prompts[lang].items()}
 
-        return image_prompt
+    def random_image(self, cat, bags=None):
+        """A random image of the category the user asked for, of all images if there is no such category"""
+        category = self.images.resolve(cat, self.image_aliases) or ImageCatalog.ALL
+        return self.images.sample(category, bags)
 
     def get_stats(self):
         stats = {}
         for lang in self.prompts:
             for header in self.prompts[lang]:
                 stats[f"{lang}-{header}"] = len(self.prompts[lang][header])
-        for folder in self.folders:
-            stats[f"image-{folder}"] = len(self.folders[folder])
+        for category in [ImageCatalog.ALL] + self.images.categories:
+            stats[f"image-{category}"] = self.images.count(category)
         return {**stats}
@@ -1,3 +1,8 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
 import os
 import random
 import time
@@ -5,6 +10,7 @@ from datetime import datetime, timedelta
 from enum import StrEnum
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
 from telegram.error import BadRequest
 from tqdm import tqdm
 
@@ -16,6 +22,21 @@ MAX_SPRINT = 120
 MIN_SPRINT_DELAY = 0
 DEFAULT_SPRINT_DELAY = 2
 MAX_SPRINT_DELAY = 10
+# Progress updates happen once a minute, each sprint on its own second of it
+PROGRESS_INTERVAL = 60
+# Seconds the "how is it going" ping stays in the chat
+PING_LIFETIME = 5
+# Joins and leaves within this many seconds are shown in one message edit
+EDIT_DEBOUNCE = 2
+
+logger = logging.getLogger(__name__)
+
+# Current time in seconds since the epoch, load tests replace it with a simulated clock
+clock = time.time
+
+
+def now():
+    return datetime.fromtimestamp(clock())
 
 
 class SprintStatus(StrEnum):
@@ -40,76 +61,129 @@ TENSES_FOR_WRITE_VERB = {
 
 
 class Sprint:
+    """A writing sprint in one chat, kept compact so that running sprints can be saved through persistence"""
+
+    __slots__ = (
+        "chat_id",
+        "message_id",
+        "thread_id",
+        "original_duration",
+        "duration",
+        "delay",
+        "status",
+        "start_date",
+        "end_date",
+        "users",
+        "ticks_without_activity",
+        "last_rendered",
+        "pending_edit",
+        "scheduler",
+        "slot",
+    )
+    # What survives a restart; the rest is rebuilt by the scheduler
+    persisted_slots = __slots__[:11]
+
+    # Edits skipped because the message would not change, across all sprints
+    skipped_edits = 0
+
     def __init__(self, duration, delay=DEFAULT_SPRINT_DELAY):
-        self.message = None
+        self.chat_id = None
+        self.message_id = None
+        self.thread_id = None
         self.original_duration = duration
         self.duration = duration
         self.delay = delay
         self.status = SprintStatus.Initialized
         self.start_date = None
         self.end_date = None
-        self.users = []
+        # Mentions of the participants by user id
+        self.users = {}
         self.ticks_without_activity = 0
+        self.last_rendered = None
+        self.pending_edit = None
+        self.scheduler = None
+        self.slot = 0
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.persisted_slots}
+
+    def __setstate__(self, state):
+        self.__init__(state["original_duration"], state["delay"])
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def bot(self):
+        return self.scheduler.bot
 
     async def plan_sprint(self, start_command_message, user=None):
         if user is None:
             user = start_command_message.from_user
         if self.status == SprintStatus.Initialized:
             self.status = SprintStatus.Planned
-            self.start_date = datetime.now() + timedelta(minutes=self.delay)
+            self.start_date = now() + timedelta(minutes=self.delay)
             self.end_date = self.start_date + timedelta(minutes=self.duration)
-            self.users = [user]
+            self.users = {user.id: user.mention_html()}
             if self.delay == 0:
                 self.status = SprintStatus.Running
-            self.message = await start_command_message.reply_html(**self.render_message())
+            rendered = self.render_message()
+            self.last_rendered = (rendered["text"], rendered["reply_markup"])
+            message = await start_command_message.reply_html(**rendered)
+            self.chat_id = message.chat_id
+            self.message_id = message.message_id
+            self.thread_id = message.message_thread_id if message.is_topic_message else None
             try:
-                await self.message.pin(disable_notification=True)
+                await message.pin(disable_notification=True)
             except BadRequest:
                 pass
 
     async def start_sprint(self):
         if self.status == SprintStatus.Planned:
             self.status = SprintStatus.Running
-            old_message = self.message
-            self.message = await old_message.reply_html(**self.render_message())
-            await old_message.delete()
+            old_message_id = self.message_id
+            await self.reply_message()
+            await self.bot.delete_message(self.chat_id, old_message_id)
             try:
-                await self.message.pin(disable_notification=True)
+                await self.bot.pin_chat_message(self.chat_id, self.message_id, disable_notification=True)
             except BadRequest:
                 pass
 
     async def add_user(self, callback_query):
         self.ticks_without_activity = 0
         if self.status in (SprintStatus.Planned, SprintStatus.Running):
-            if callback_query.from_user in self.users:
+            if callback_query.from_user.id in self.users:
                 await callback_query.answer("Ви вже у спринті!")
             else:
-                self.users.append(callback_query.from_user)
-                await self.edit_message()
+                self.users[callback_query.from_user.id] = callback_query.from_user.mention_html()
+                self.schedule_edit()
                 await callback_query.answer("Додано до спринту!")
 
         else:
-            callback_query.answer("Ви не можете додатися до цього спринту.")
+            await callback_query.answer("Ви не можете додатися до цього спринту.")
 
     async def remove_user(self, user):
         self.ticks_without_activity = 0
         if self.status in (SprintStatus.Planned, SprintStatus.Running):
-            self.users.remove(user)
-            await self.edit_message()
+            self.users.pop(user.id, None)
+            self.schedule_edit()
 
     async def cancel_sprint(self):
         if self.status == SprintStatus.Planned:
             self.status = SprintStatus.CancelledWhilePlanned
         elif self.status in (SprintStatus.Running, SprintStatus.Ending):
-            self.end_date = datetime.now()
+            self.end_date = now()
             self.duration = max(0, int((self.end_date - self.start_date).total_seconds() // 60))
             self.status = SprintStatus.Cancelled
-        await self.edit_message()
+        self.cancel_pending_edit()
         try:
-            await self.message.unpin()
-        except BadRequest:
-            pass
-        self.job.schedule_removal()
+            await self.edit_message()
+            try:
+                await self.bot.unpin_chat_message(self.chat_id, self.message_id)
+            except BadRequest:
+                pass
+        finally:
+            # Even if Telegram fails, so that the chat can start a new sprint
+            self.scheduler.remove(self)
 
     def render_message(self):
         if self.status in (SprintStatus.Planned, SprintStatus.Running):
@@ -150,8 +224,8 @@ class Sprint:
         message = f"""<b>Спринт {self.status.value}{planned_start}</b>!\n
 {TENSES_FOR_WRITE_VERB[self.status]} <b>{formatted_duration}</b>, з <b>{self.start_date:%H:%M}</b> до <b>{self.end_date:%H:%M}</b>.\n
 <b>Учасники: </b>"""
-        message += ", ".join(u.mention_html() for u in self.users)
-        elapsed_duration = (datetime.now() - self.start_date).total_seconds()
+        message += ", ".join(self.users.values())
+        elapsed_duration = (now() - self.start_date).total_seconds()
         if self.status == SprintStatus.Running:
             message += "\n" + tqdm.format_meter(
                 n=int(elapsed_duration // 60),
@@ -164,55 +238,222 @@ class Sprint:
 
         return {"text": message, "reply_markup": reply_markup}
 
+    async def reply_message(self):
+        """Post the rendered sprint as a reply to its current message and make it the sprint message"""
+        rendered = self.render_message()
+        self.last_rendered = (rendered["text"], rendered["reply_markup"])
+        message = await self.bot.send_message(
+            self.chat_id,
+            reply_to_message_id=self.message_id,
+            message_thread_id=self.thread_id,
+            parse_mode=ParseMode.HTML,
+            **rendered,
+        )
+        self.message_id = message.message_id
+
     async def edit_message(self):
+        rendered = self.render_message()
+        shown = (rendered["text"], rendered["reply_markup"])
+        if shown == self.last_rendered:
+            Sprint.skipped_edits += 1
+            return
         try:
-            await self.message.edit_text(**self.render_message())
+            await self.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message_id, **rendered)
+        except BadRequest as e:
+            # Unless the message is the same as before, it is edited again on the next tick
+            if "not modified" not in e.message:
+                return
+        self.last_rendered = shown
+
+    def schedule_edit(self):
+        """Edit the message a bit later, so that a burst of joins and leaves becomes a single edit"""
+        if self.pending_edit is None:
+            self.pending_edit = self.scheduler.call_later(EDIT_DEBOUNCE, self.run_pending_edit)
+
+    def cancel_pending_edit(self):
+        if self.pending_edit is not None:
+            self.scheduler.cancel(self.pending_edit)
+            self.pending_edit = None
+
+    async def run_pending_edit(self):
+        self.pending_edit = None
+        await self.edit_message()
+
+    async def delete_message(self, message_id):
+        try:
+            await self.bot.delete_message(self.chat_id, message_id)
         except BadRequest:
-            # Message is the same as before
+            # Already deleted
             pass
 
     async def end_sprint(self):
         if self.status == SprintStatus.Running:
             self.status = SprintStatus.Ending
+            self.cancel_pending_edit()
+        elif self.status != SprintStatus.Ending:
+            # A sprint saved while ending is finished after a restart
+            raise AttributeError("Cannot end sprint before starting!")
+        try:
             await self.edit_message()
             self.status = SprintStatus.Finished
             try:
-                await self.message.unpin()
+                await self.bot.unpin_chat_message(self.chat_id, self.message_id)
             except BadRequest:
                 pass
-            self.message = await self.message.reply_html(**self.render_message())
-            self.job.schedule_removal()
-        else:
-            raise AttributeError("Cannot end sprint before starting!")
+            await self.reply_message()
+        finally:
+            # The end event runs once, so the sprint is removed even if Telegram fails
+            self.scheduler.remove(self)
 
-    async def leave_or_cancel_sprint(self, callback_query):
+    async def leave_or_cancel_sprint(self, callback_query, is_chat_admin):
         if self.status in (SprintStatus.Planned, SprintStatus.Running):
-            if callback_query.from_user in self.users and len(self.users) > 1:
+            if callback_query.from_user.id in self.users and len(self.users) > 1:
                 await self.remove_user(callback_query.from_user)
                 await callback_query.answer("Вас вилучено зі спринту")
-            elif ((callback_query.from_user in self.users) and (len(self.users) == 1)) or (
-                callback_query.from_user.id
-                in [admin.user.id for admin in await callback_query.message.chat.get_administrators()]
+            elif ((callback_query.from_user.id in self.users) and (len(self.users) == 1)) or await is_chat_admin(
+                callback_query.message.chat, callback_query.from_user.id
             ):
                 await self.cancel_sprint()
                 await callback_query.answer("Спринт скасовано")
             else:
                 await callback_query.answer("Ви не маєте права скасувати спринт")
 
-    async def tick(self, context):
-        if self.status == SprintStatus.Planned:
-            await self.start_sprint()
-        if (self.status == SprintStatus.Running) and ((self.end_date - datetime.now()).total_seconds() < 30):
-            await self.end_sprint()
-        elif self.ticks_without_activity >= MAX_SPRINT_DELAY:
+    async def tick(self):
+        if self.ticks_without_activity >= MAX_SPRINT_DELAY:
             temp_msg_text = (
                 f"Як прогрес<a href='https://{os.environ['HOSTNAME']}/{str(random.randint(0,1000000))}'>?</a>"
             )
-            temp_msg = await self.message.reply_html(
-                temp_msg_text, disable_notification=True, disable_web_page_preview=False
+            temp_msg = await self.bot.send_message(
+                self.chat_id,
+                temp_msg_text,
+                reply_to_message_id=self.message_id,
+                message_thread_id=self.thread_id,
+                parse_mode=ParseMode.HTML,
+                disable_notification=True,
+                disable_web_page_preview=False,
             )
-            time.sleep(5)
-            await temp_msg.delete()
+            self.scheduler.call_later(PING_LIFETIME, functools.partial(self.delete_message, temp_msg.message_id))
             self.ticks_without_activity = 0
         self.ticks_without_activity += 1
         await self.edit_message()
+
+
+class SprintScheduler:
+    """Runs the start, progress and end events of all sprints from one time-ordered heap.
+
+    Sprints are kept by chat id, and their progress updates are spread over the seconds of a minute,
+    so that sprints started together do not edit their messages in the same second."""
+
+    def __init__(self):
+        self.sprints = {}
+        self.bot = None
+        self._events = []
+        self._counter = itertools.count()
+        self._slots = [0] * PROGRESS_INTERVAL
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._running = set()
+        self._cancelled = set()
+
+    def get(self, chat_id):
+        return self.sprints.get(chat_id)
+
+    def add(self, sprint):
+        sprint.scheduler = self
+        sprint.slot = min(range(PROGRESS_INTERVAL), key=self._slots.__getitem__)
+        self._slots[sprint.slot] += 1
+        self.sprints[sprint.chat_id] = sprint
+        if sprint.status == SprintStatus.Planned and sprint.end_date <= now():
+            # The whole sprint passed while the bot was down, only its end is left to announce
+            sprint.status = SprintStatus.Running
+        if sprint.status == SprintStatus.Planned:
+            self._push(sprint.start_date.timestamp(), sprint, sprint.start_sprint)
+        elif sprint.status == SprintStatus.Running:
+            self._push_progress(sprint)
+        self._push(sprint.end_date.timestamp(), sprint, sprint.end_sprint)
+
+    def restore(self, sprints):
+        """Take over the saved sprints dict and reschedule the sprints in it, late events fire at once.
+        A sprint saved while ending is finished, one saved while being cancelled is dropped"""
+        self.sprints = sprints
+        for chat_id, sprint in list(sprints.items()):
+            if sprint.status in (SprintStatus.Planned, SprintStatus.Running, SprintStatus.Ending):
+                self.add(sprint)
+            else:
+                del sprints[chat_id]
+        if sprints:
+            logger.info("Resumed %d sprints", len(sprints))
+
+    def remove(self, sprint):
+        if self.sprints.get(sprint.chat_id) is sprint:
+            del self.sprints[sprint.chat_id]
+            self._slots[sprint.slot] -= 1
+
+    def call_later(self, delay, action):
+        """Run a coroutine function in delay seconds, whatever happens to the sprints meanwhile.
+        Returns a handle for cancel()"""
+        return self._push(clock() + delay, None, action)
+
+    def cancel(self, handle):
+        self._cancelled.add(handle)
+
+    def _push(self, when, sprint, action):
+        handle = next(self._counter)
+        heapq.heappush(self._events, (when, handle, sprint, action))
+        if self._events[0][0] == when:
+            self._wakeup.set()
+        return handle
+
+    def _push_progress(self, sprint):
+        """Schedule the next progress update, unless the sprint ends before it"""
+        start = sprint.start_date.timestamp() + sprint.slot
+        elapsed_intervals = max(0, int((clock() - start) // PROGRESS_INTERVAL) + 1)
+        when = start + elapsed_intervals * PROGRESS_INTERVAL
+        if when < sprint.end_date.timestamp() - PROGRESS_INTERVAL / 2:
+            self._push(when, sprint, sprint.tick)
+
+    async def _run_event(self, sprint, action):
+        if sprint is not None and self.sprints.get(sprint.chat_id) is not sprint:
+            return
+        try:
+            await action()
+        except Exception:
+            logger.exception("Scheduled %s failed", getattr(action, "__name__", action))
+        if sprint is not None and sprint.status == SprintStatus.Running and action != sprint.end_sprint:
+            self._push_progress(sprint)
+
+    def run_due(self, current_time):
+        """Start every event due at current_time, returns the started tasks"""
+        started = []
+        while self._events and self._events[0][0] <= current_time:
+            _, handle, sprint, action = heapq.heappop(self._events)
+            if handle in self._cancelled:
+                self._cancelled.discard(handle)
+            elif sprint is None or self.sprints.get(sprint.chat_id) is sprint:
+                task = asyncio.create_task(self._run_event(sprint, action))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+                started.append(task)
+        return started
+
+    async def run(self):
+        """Wait for the earliest event and run every due one, forever"""
+        while True:
+            current_time = clock()
+            self.run_due(current_time)
+            self._wakeup.clear()
+            timeout = self._events[0][0] - current_time if self._events else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        """Stop running the events, e.g. to run them from a simulated clock with run_due"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
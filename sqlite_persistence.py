@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistence that keeps every chat, user and conversation in its own SQLite row
+"""
+
+import json
+import logging
+import pickle
+import sqlite3
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS singletons (name TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS image_file_ids (id TEXT PRIMARY KEY, file_id TEXT NOT NULL);
+"""
+
+
+class _PickleUnpickler(pickle.Unpickler):
+    """Reads PicklePersistence files, which store bots as persistent ids"""
+
+    def persistent_load(self, pid):
+        return None
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores the bot data in a SQLite database in WAL mode.
+
+    The application only hands over chats and users that changed since the last update, and each of them
+    is written as a single row, so an update costs as much as the data that changed rather than the data stored.
+    The bot and callback data are kept in one row each and are only written when they change.
+    Worker processes sharing the database pass their `shard`, to keep their own bot and callback data,
+    which start as a copy of the data of the single process mode.
+    The Telegram file ids of the uploaded images are shared by all of them, a row per image."""
+
+    def __init__(self, filepath="db.sqlite3", store_data=None, update_interval=60, shard=None):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self.shard = shard
+        self._connection = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # With WAL a commit only fsyncs at checkpoints, and a crash can lose at most the last commits
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._singletons = {}
+
+    def _read_rows(self, table):
+        rows = self._connection.execute(f"SELECT id, data FROM {table}")
+        return {row_id: pickle.loads(data) for row_id, data in rows}
+
+    def _write_rows(self, table, rows):
+        with self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO {table} (id, data) VALUES (?, ?)",
+                ((row_id, pickle.dumps(data, pickle.HIGHEST_PROTOCOL)) for row_id, data in rows),
+            )
+
+    def _read_singleton(self, name, default):
+        names = [name] if self.shard is None else [f"{name}:{self.shard}", name]
+        for row_name in names:
+            row = self._connection.execute("SELECT data FROM singletons WHERE name = ?", (row_name,)).fetchone()
+            if row is not None:
+                if row_name == names[0]:
+                    self._singletons[name] = row[0]
+                return pickle.loads(row[0])
+        return default
+
+    def _write_singleton(self, name, data):
+        data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        if self._singletons.get(name) == data:
+            return
+        row_name = name if self.shard is None else f"{name}:{self.shard}"
+        self._connection.execute("INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)", (row_name, data))
+        self._singletons[name] = data
+
+    def _write_conversation(self, name, key, new_state):
+        key = json.dumps(key)
+        if new_state is None:
+            self._connection.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key))
+        else:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                (name, key, pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL)),
+            )
+
+    async def get_user_data(self):
+        return self._read_rows("user_data")
+
+    async def get_chat_data(self):
+        return self._read_rows("chat_data")
+
+    async def get_bot_data(self):
+        return self._read_singleton("bot_data", {})
+
+    async def get_callback_data(self):
+        return self._read_singleton("callback_data", None)
+
+    async def get_conversations(self, name):
+        return {
+            tuple(json.loads(key)): pickle.loads(state)
+            for key, state in self._connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        }
+
+    async def update_conversation(self, name, key, new_state):
+        self._write_conversation(name, key, new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._write_rows("user_data", [(user_id, data)])
+
+    async def update_chat_data(self, chat_id, data):
+        self._write_rows("chat_data", [(chat_id, data)])
+
+    async def update_bot_data(self, data):
+        self._write_singleton("bot_data", data)
+
+    async def update_callback_data(self, data):
+        self._write_singleton("callback_data", data)
+
+    async def drop_chat_data(self, chat_id):
+        self._connection.execute("DELETE FROM chat_data WHERE id = ?", (chat_id,))
+
+    async def drop_user_data(self, user_id):
+        self._connection.execute("DELETE FROM user_data WHERE id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def get_image_file_ids(self):
+        return dict(self._connection.execute("SELECT id, file_id FROM image_file_ids"))
+
+    def get_image_file_id(self, image_id):
+        row = self._connection.execute("SELECT file_id FROM image_file_ids WHERE id = ?", (image_id,)).fetchone()
+        return row and row[0]
+
+    def update_image_file_id(self, image_id, file_id):
+        """Store the file id of an image, or forget it for file_id None"""
+        if file_id is None:
+            self._connection.execute("DELETE FROM image_file_ids WHERE id = ?", (image_id,))
+        else:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO image_file_ids (id, file_id) VALUES (?, ?)", (image_id, file_id)
+            )
+
+    async def flush(self):
+        self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def migrate_from_pickle(self, pickle_path):
+        """Copy everything from a single-file PicklePersistence into this database"""
+        with open(pickle_path, "rb") as pickle_file:
+            data = _PickleUnpickler(pickle_file).load()
+        self._write_rows("chat_data", (data.get("chat_data") or {}).items())
+        self._write_rows("user_data", (data.get("user_data") or {}).items())
+        if data.get("bot_data") is not None:
+            self._write_singleton("bot_data", data["bot_data"])
+        if data.get("callback_data") is not None:
+            self._write_singleton("callback_data", data["callback_data"])
+        with self._connection:
+            self._connection.execute("BEGIN")
+            for name, conversations in (data.get("conversations") or {}).items():
+                for key, state in conversations.items():
+                    self._write_conversation(name, key, state)
+        logger.info(
+            "Migrated %d chats and %d users from %s to %s",
+            len(data.get("chat_data") or {}),
+            len(data.get("user_data") or {}),
+            pickle_path,
+            self.filepath,
+        )
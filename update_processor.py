@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Processes updates of different chats concurrently, and updates of one chat strictly in order
+"""
+
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates let in at once per running slot, counting those that wait for their chat
+ADMITTED_PER_SLOT = 32
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs at most `max_running_updates` updates at once, each chat waiting for its previous update.
+
+    The application starts a task per update in the order they arrive. PTB lets at most
+    `max_admitted_updates` of them into do_process_update, in the same order since asyncio semaphores are fair,
+    and every task puts itself in the queue of its chat before its first await there, so the order inside a chat
+    can't change. An update that waits for its chat doesn't hold one of the running slots."""
+
+    def __init__(self, max_running_updates, max_admitted_updates=None):
+        super().__init__(max_admitted_updates or max_running_updates * ADMITTED_PER_SLOT)
+        self.max_running_updates = max_running_updates
+        self.slots = asyncio.BoundedSemaphore(max_running_updates)
+        # chat id -> future that is done when the last queued update of the chat is processed
+        self.chat_tails = {}
+        self.waiting = 0
+        self.running = 0
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def get_chat_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return "user", update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.get_chat_key(update)
+        previous = self.chat_tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self.chat_tails[key] = done
+        arrived = time.monotonic()
+        self.waiting += 1
+        started = False
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            async with self.slots:
+                self.waiting -= 1
+                started = True
+                self.running += 1
+                wait = time.monotonic() - arrived
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+                    self.processed += 1
+        finally:
+            if not started:
+                # Cancelled while waiting for the chat or a slot
+                self.waiting -= 1
+                coroutine.close()
+            if previous is not None and not previous.done():
+                # The next update of the chat still has to wait for the previous one
+                previous.add_done_callback(lambda _: self._finish(key, done))
+            else:
+                self._finish(key, done)
+
+    def _finish(self, key, done):
+        done.set_result(None)
+        if key is not None and self.chat_tails.get(key) is done:
+            del self.chat_tails[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def get_stats(self):
+        return {
+            "queued": self.waiting,
+            "running": self.running,
+            "processed": self.processed,
+            "wait-avg-ms": round(self.total_wait / self.processed * 1000, 1) if self.processed else 0,
+            "wait-max-ms": round(self.max_wait * 1000, 1),
+        }
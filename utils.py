@@ -1,7 +1,17 @@
+import re
+import string
+import time
+from collections import OrderedDict
 from functools import wraps
 
 from telegram import MessageEntity
 
+NON_LETTERS = string.whitespace + string.punctuation + string.digits
+# A word is a whitespace-separated run with at least one character that is not punctuation
+WORD_RE = re.compile(r"[^\s{}]\S*".format(re.escape(string.punctuation)))
+SPACE_RE = re.compile(r"\s+")
+NON_SPACE_RE = re.compile(r"\S*")
+
 
 def text_or_caption(message):
     if message:
@@ -12,7 +22,7 @@ def text_or_caption(message):
 
 def get_command_suffix(message, bot_username, prefix=""):
     commands = [
-        s.lower().replace(bot_username, "")
+        s.lower().replace(bot_username.lower(), "")
         for s in list(message.parse_entities([MessageEntity.BOT_COMMAND]).values())
         + list(message.parse_caption_entities([MessageEntity.BOT_COMMAND]).values())
         if s.lower().startswith(prefix)
@@ -50,3 +60,139 @@ def format_numeral_nouns(num, word):
         return f"{num} {word[1]}"
     else:
         return f"{num} {word[2]}"
+
+
+def count_text(txt):
+    """Count words, characters and letters of a text without splitting or copying it"""
+    words = sum(1 for _ in WORD_RE.finditer(txt))
+    letters = len(txt) - sum(map(txt.count, NON_LETTERS))
+    return words, len(txt), letters
+
+
+class TextCounter:
+    """Count words, characters and letters of a text fed in chunks, exactly like count_text of the whole text.
+    A word split between two chunks is counted once"""
+
+    def __init__(self):
+        self.words = self.characters = self.letters = 0
+        # Whether the text so far ends inside a run of non-space characters, and whether that run has a word
+        self.in_run = False
+        self.run_is_word = False
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        first = last = None
+        words = 0
+        for last in WORD_RE.finditer(chunk):
+            first = first or last
+            words += 1
+        run_end = NON_SPACE_RE.match(chunk).end()
+        continues_run = self.in_run and run_end > 0
+        if continues_run and self.run_is_word and first is not None and first.start() < run_end:
+            words -= 1
+        self.words += words
+        self.characters += len(chunk)
+        self.letters += len(chunk) - sum(map(chunk.count, NON_LETTERS))
+        # A word runs to the end of its run of non-space characters
+        ends_with_word = last is not None and last.end() == len(chunk)
+        if continues_run and run_end == len(chunk):
+            self.run_is_word = self.run_is_word or ends_with_word
+        else:
+            self.run_is_word = ends_with_word
+        self.in_run = not chunk[-1].isspace()
+
+    @property
+    def counts(self):
+        return self.words, self.characters, self.letters
+
+
+def count_text_pieces(pieces):
+    """Count words, characters and letters of text pieces as if they were joined by single spaces
+    with every run of whitespace collapsed to one space, without building the joined text"""
+    words = characters = letters = 0
+    ends_with_space = False
+    for i, piece in enumerate(pieces):
+        if i and not ends_with_space:
+            characters += 1
+            ends_with_space = True
+        if not piece:
+            continue
+        words += sum(1 for _ in WORD_RE.finditer(piece))
+        spaces = 0
+        for match in SPACE_RE.finditer(piece):
+            spaces += match.end() - match.start()
+            if not (match.start() == 0 and ends_with_space):
+                characters += 1
+        visible = len(piece) - spaces
+        characters += visible
+        letters += visible - sum(map(piece.count, string.punctuation + string.digits))
+        ends_with_space = piece[-1].isspace()
+    return words, characters, letters
+
+
+def iter_node_text(nodes):
+    """Yield text of a Telegraph node tree in document order, one piece per HTML text node"""
+    stack = [iter(nodes)]
+    text = None
+    while stack:
+        for node in stack[-1]:
+            if isinstance(node, str):
+                # Adjacent strings form one text node in the rendered page
+                text = node if not text else text + node
+                continue
+            if text:
+                yield text
+                text = None
+            if node.get("children"):
+                stack.append(iter(node["children"]))
+                break
+        else:
+            stack.pop()
+            if text:
+                yield text
+                text = None
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, maxsize=256, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Webhook server of the bot, handing the updates over to one or several worker processes, each serving the same chats
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+import tornado.web
+from telegram import Bot, Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the workers to report their metrics
+METRICS_TIMEOUT = 5
+
+
+def get_update_chat_id(data):
+    """The chat of a raw update, or the user for updates without a chat such as inline queries"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        user = value.get("from") or value.get("user")
+        if chat:
+            return chat["id"]
+        if user:
+            return user["id"]
+    return None
+
+
+def get_worker(data, workers):
+    chat_id = get_update_chat_id(data)
+    return chat_id % workers if chat_id is not None else 0
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, dispatch, secret_token):
+        self.dispatch = dispatch
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret_token:
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if not isinstance(data, dict):
+            raise tornado.web.HTTPError(400)
+        await self.dispatch(data)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, collect):
+        self.collect = collect
+
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(metrics.render(await self.collect()))
+
+
+async def listen(dispatch, collect, listen_address, port, url_path, secret_token):
+    """Serve the webhook and /metrics until SIGINT or SIGTERM"""
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+    server = tornado.web.Application(
+        [
+            (r"/metrics", MetricsHandler, {"collect": collect}),
+            (rf"/{url_path}", WebhookHandler, {"dispatch": dispatch, "secret_token": secret_token}),
+        ]
+    ).listen(port, address=listen_address)
+    logger.info("Listening on %s:%d", listen_address, port)
+    await stop.wait()
+    server.stop()
+
+
+async def serve_single(app, webhook_url, allowed_updates, secret_token, **listen_kwargs):
+    """Run the application in this process, like Application.run_webhook"""
+
+    async def dispatch(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    async def collect():
+        return metrics.get_snapshot()
+
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        if webhook_url:
+            await app.bot.set_webhook(webhook_url, allowed_updates=allowed_updates, secret_token=secret_token)
+        await app.start()
+        await listen(dispatch, collect, secret_token=secret_token, **listen_kwargs)
+        await app.stop()
+
+
+def run_worker(build_app, worker, updates, replies):
+    """Run the application of one worker, feeding it the updates from the queue until None"""
+    # Ctrl+C reaches all processes, the listener stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # The forked worker starts with a copy of the listener's metrics, which the listener reports itself
+    metrics.reset()
+    asyncio.run(serve_worker(build_app(worker), updates, replies))
+
+
+async def serve_worker(app, updates, replies):
+    loop = asyncio.get_running_loop()
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            if isinstance(data, int):
+                # A metrics request with its id
+                replies.put((data, metrics.get_snapshot()))
+                continue
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        await app.stop()
+
+
+async def serve_workers(build_app, workers, token, webhook_url, allowed_updates, secret_token, **listen_kwargs):
+    context = multiprocessing.get_context("fork")
+    queues = [context.SimpleQueue() for _ in range(workers)]
+    replies = context.Queue()
+    processes = [
+        context.Process(
+            target=run_worker, args=(build_app, worker, updates, replies), name=f"worker-{worker}", daemon=True
+        )
+        for worker, updates in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    request_ids = itertools.count()
+    metrics_lock = asyncio.Lock()
+
+    async def dispatch(data):
+        queues[get_worker(data, workers)].put(data)
+
+    async def collect():
+        loop = asyncio.get_running_loop()
+        async with metrics_lock:
+            request_id = next(request_ids)
+            for updates in queues:
+                updates.put(request_id)
+            snapshots = []
+            deadline = time.monotonic() + METRICS_TIMEOUT
+            while len(snapshots) < workers:
+                try:
+                    reply_id, snapshot = await loop.run_in_executor(
+                        None, replies.get, True, max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    logger.warning("Only %d of %d workers reported their metrics", len(snapshots), workers)
+                    break
+                # Late replies to a request that timed out are dropped
+                if reply_id == request_id:
+                    snapshots.append(snapshot)
+        # With what the listener measured itself, such as loading the prompts before forking
+        return metrics.merge([metrics.get_snapshot()] + snapshots)
+
+    try:
+        if webhook_url:
+            async with Bot(token) as bot:
+                await bot.set_webhook(webhook_url, allowed_updates=allowed_updates, secret_token=secret_token)
+        await listen(dispatch, collect, secret_token=secret_token, **listen_kwargs)
+    finally:
+        for updates in queues:
+            updates.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, lambda: [process.join() for process in processes])
+
+
+def run_webhook(
+    build_app,
+    workers=1,
+    listen_address="127.0.0.1",
+    port=80,
+    url_path="",
+    token=None,
+    webhook_url=None,
+    secret_token=None,
+    allowed_updates=None,
+):
+    """Listen for webhook updates and process them with the application built by `build_app(worker)`.
+
+    With several workers every worker is a process of its own, and the updates of a chat always go to the worker
+    `chat_id % workers`, so its sprints and jobs stay in one process. The workers are forked, so the data loaded
+    before this call is shared with them. A single worker runs in this process and is built with worker None.
+
+    The webhook is only set when `webhook_url` is given, so the server can be tried locally by posting updates to it.
+    The metrics of all workers are served at /metrics."""
+    listen_kwargs = {"listen_address": listen_address, "port": port, "url_path": url_path}
+    if workers > 1:
+        asyncio.run(
+            serve_workers(build_app, workers, token, webhook_url, allowed_updates, secret_token, **listen_kwargs)
+        )
+    else:
+        asyncio.run(serve_single(build_app(None), webhook_url, allowed_updates, secret_token, **listen_kwargs))